@@ -0,0 +1,56 @@
+"""
+Compare the in-process secret encryption with one openssl process per secret.
+
+usage: python benchmarks/secrets.py [n_secrets]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+# run from a checkout, the script folder is replaced because this file would shadow the secrets module
+sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from ignishpc.common import crypto
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    values = ["password-" + str(i) for i in range(n)]
+    openssl = shutil.which("openssl") is not None
+    with tempfile.NamedTemporaryFile("w", prefix="ignis-secret-") as kfile:
+        kfile.write("benchmark-secret\n")
+        kfile.flush()
+
+        openssl_time = None
+        if openssl:
+            start = time.perf_counter()
+            encoded = [crypto._openssl(value, kfile.name, "-e") for value in values]
+            openssl_time = time.perf_counter() - start
+            print(f"openssl subprocess: {n} secrets in {openssl_time * 1000:.1f} ms")
+        else:
+            print("openssl subprocess: not available, openssl not found")
+
+        if crypto.CRYPTO_ERROR is not None:
+            print("in-process: not available,", crypto.CRYPTO_ERROR)
+            return
+
+        start = time.perf_counter()
+        crypto.encrypt(values, kfile.name)
+        crypto_time = time.perf_counter() - start
+        speedup = f" ({openssl_time / crypto_time:.1f}x)" if openssl_time is not None else ""
+        print(f"in-process:         {n} secrets in {crypto_time * 1000:.1f} ms{speedup}")
+
+        if not openssl:
+            print("format compatibility not checked")
+            return
+        if crypto.decrypt(encoded, kfile.name) != values:
+            raise RuntimeError("openssl output can not be decrypted in-process")
+        if [crypto._openssl(value, kfile.name, "-d") for value in crypto.encrypt(values, kfile.name)] != values:
+            raise RuntimeError("in-process output can not be decrypted by openssl")
+        print("formats are compatible")
+
+
+if __name__ == "__main__":
+    main()
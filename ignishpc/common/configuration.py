@@ -4,16 +4,23 @@ import random
 import subprocess
 import re
 import sys
+import shutil
+import marshal
+import hashlib
+import functools
 
-from ruamel.yaml import YAML, CommentedMap
+from ruamel.yaml import YAML, CommentedMap, CommentedSeq
 from ruamel.yaml.parser import MarkedYAMLError
 from ruamel.yaml.comments import CommentedBase
 
+from ignishpc.common import profiling
+
 USER_CONFIG = os.getenv("IGNIS_USER_CONFIG", default=os.path.expanduser("~/.ignis/etc/ignis.yaml"))
 SYSTEM_CONFIG = os.getenv("IGNIS_SYSTEM_CONFIG", default="/etc/ignis/ignis.yaml")
+CACHE_CONFIG = os.getenv("IGNIS_CACHE_CONFIG", default=os.path.join(os.path.dirname(USER_CONFIG), "ignis.cache"))
 yaml = YAML()
 _KEY_CRYPTO = "ignis.crypto.secret"
-props = yaml.load("""
+_DEFAULTS = """
 ignis:
   container:
     docker:
@@ -23,6 +30,7 @@ ignis:
       tag: "latest"
       root: false
       network: "default"
+      mirror: ""
     singularity:
       source: "${HOME}/.ignis/images"
       default: "ignishpc.sif"
@@ -30,7 +38,8 @@ ignis:
     hostpipe: false
     writable: false
     #provider: ""
-""")
+"""
+props = yaml.load(_DEFAULTS)
 
 
 def get_property(key, default=None):
@@ -128,47 +137,59 @@ def yaml_merge(target, source):
             target[key] = value
 
 
-def __check_openssl():
-    try:
-        return subprocess.run(["openssl", "version"], capture_output=True).returncode == 0
-    except:
-        return False
+@functools.lru_cache(maxsize=None)
+def _check_openssl():
+    with profiling.timed("probe openssl"):
+        if shutil.which("openssl") is None:
+            return False
+        try:
+            return subprocess.run(["openssl", "version"], capture_output=True).returncode == 0
+        except:
+            return False
 
 
 __env_vars = re.compile(r'(?<!\\)\$(\{([^}]+)\})')
-__has_openssl = __check_openssl()
+__env_used = set()
 
 
 def __yaml_expand(m):
+    __env_used.add(m.group(2))
     if m.group(2) in os.environ:
         return os.environ[m.group(2)]
     return m.group(2)
 
 
-def __yaml_encode(v):
-    if not has_property(_KEY_CRYPTO):
-        raise RuntimeError(f"'{_KEY_CRYPTO}' not found")
-    if not __has_openssl:
-        raise RuntimeError("openssl is not available")
-    secret = get_string(_KEY_CRYPTO)
-    cmd = "openssl aes-256-cbc -pbkdf2 -a -e -kfile"
-    encoded = subprocess.run(cmd.split() + [secret], input=v, capture_output=True, encoding="utf-8", check=True).stdout
-    return "$" + encoded.strip() + "$"
-
-
-def __yaml_update(m):
+def __yaml_encode(secrets):
+    try:
+        if not has_property(_KEY_CRYPTO):
+            raise RuntimeError(f"'{_KEY_CRYPTO}' not found")
+        from ignishpc.common import crypto
+        if crypto.CRYPTO_ERROR is not None and not _check_openssl():
+            raise RuntimeError("openssl is not available")
+        encoded = crypto.encrypt([m[key] for m, key in secrets], get_string(_KEY_CRYPTO))
+        for (m, key), value in zip(secrets, encoded):
+            m[key] = "$" + value + "$"
+    except Exception as ex:
+        for _, key in secrets:
+            print(f"warning: secret key '{key}' found but: {str(ex)}", file=sys.stderr)
+
+
+def __yaml_update(m, secrets=None):
+    # secrets are collected and encrypted together at the end
+    top = secrets is None
+    if top:
+        secrets = list()
     for key in m:
         value = m[key]
         if isinstance(value, CommentedMap):
-            m[key] = __yaml_update(value)
+            m[key] = __yaml_update(value, secrets)
         elif isinstance(value, str) and len(value) > 0:
             if "${" in value:
                 m[key] = __env_vars.sub(__yaml_expand, value)
             elif not (value[0] == '$' and value[-1] == '$') and key[0] == '$' and key[-1] == '$':
-                try:
-                    m[key] = __yaml_encode(value)
-                except Exception as ex:
-                    print(f"warning: secret key '{key}' found but: {str(ex)}", file=sys.stderr)
+                secrets.append((m, key))
+    if top and len(secrets) > 0:
+        __yaml_encode(secrets)
     return m
 
 
@@ -180,31 +201,145 @@ def read_file_config(path, update=True):
         return __yaml_update(data) if update else data
 
 
+@functools.lru_cache(maxsize=None)
 def _check_singularity():
+    with profiling.timed("probe singularity"):
+        if shutil.which("singularity") is None:
+            return False
+        try:
+            return subprocess.run(["singularity", "version"], capture_output=True).returncode == 0
+        except:
+            return False
+
+
+_CACHE_VERSION = 2
+# snapshots include the defaults, they are discarded when a new release changes them
+_CACHE_DEFAULTS = hashlib.sha256(_DEFAULTS.encode("utf-8")).hexdigest()
+
+
+def to_plain(value):
+    if isinstance(value, dict):
+        return {to_plain(key): to_plain(entry) for key, entry in value.items()}
+    if isinstance(value, list):
+        return [to_plain(entry) for entry in value]
+    for t in (bool, int, float, str):
+        if isinstance(value, t):
+            return t(value)
+    return value if value is None else str(value)
+
+
+def __from_plain(value):
+    if isinstance(value, dict):
+        m = CommentedMap()
+        for key, entry in value.items():
+            m[key] = __from_plain(entry)
+        return m
+    if isinstance(value, list):
+        return CommentedSeq([__from_plain(entry) for entry in value])
+    return value
+
+
+def __plain_secrets(m):
+    for key, value in m.items():
+        if isinstance(value, dict):
+            if __plain_secrets(value):
+                return True
+        elif isinstance(value, str) and len(value) > 0 and isinstance(key, str) and \
+                not (value[0] == '$' and value[-1] == '$') and key[0] == '$' and key[-1] == '$':
+            return True
+    return False
+
+
+def __stat(path):
     try:
-        return subprocess.run(["singularity", "version"], capture_output=True).returncode == 0
-    except:
-        return False
+        st = os.stat(path)
+        return [path, st.st_mtime_ns, st.st_size]
+    except OSError:
+        return [path, None, None]
 
 
-def load_config(path):
+def __cache_load(sources):
+    try:
+        with open(CACHE_CONFIG, "rb") as file:
+            data = marshal.load(file)
+        if data["version"] != _CACHE_VERSION or data["defaults"] != _CACHE_DEFAULTS or data["sources"] != sources:
+            return None
+        if any(__stat(stat[0]) != stat for stat in data["stats"]):
+            return None
+        if any(os.environ.get(name) != value for name, value in data["env"].items()):
+            return None
+        # a provider resolved by probing is only valid for the same singularity binary
+        if data["probe"] is not None and __stat(shutil.which("singularity") or "") != data["probe"]:
+            return None
+        return data["props"]
+    except Exception:
+        return None
+
+
+def __cache_save(sources, stats, env, probe):
+    # Secrets are only cached encrypted, a plain secret means that encryption failed
+    if __plain_secrets(props):
+        return
+    tmp = CACHE_CONFIG + "." + str(os.getpid())
+    try:
+        os.makedirs(os.path.dirname(CACHE_CONFIG), exist_ok=True)
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as file:
+            marshal.dump({
+                "version": _CACHE_VERSION,
+                "defaults": _CACHE_DEFAULTS,
+                "sources": sources,
+                "stats": stats,
+                "env": {name: os.environ.get(name) for name in sorted(env)},
+                "probe": probe,
+                "props": to_plain(props)
+            }, file)
+        os.replace(tmp, CACHE_CONFIG)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def load_config(path, cache=True):
     ok = True
-    for file in [SYSTEM_CONFIG, USER_CONFIG, path]:
-        if file is not None and os.path.exists(file):
-            try:
-                yaml_merge(props, read_file_config(file, False))
-            except:
-                ok = False
+    sources = [SYSTEM_CONFIG, USER_CONFIG, os.path.abspath(path) if path is not None else None]
+    snapshot = __cache_load(sources) if cache else None
 
-    if not has_property("ignis.container.provider"):
-        set_property("ignis.container.provider", "singularity" if _check_singularity() else "docker")
+    if snapshot is not None:
+        props.clear()
+        props.update(__from_plain(snapshot))
+    else:
+        stats = [__stat(file) for file in sources if file is not None]
+        for file in sources:
+            if file is not None and os.path.exists(file):
+                try:
+                    yaml_merge(props, read_file_config(file, False))
+                except:
+                    ok = False
+
+        env = set()
+        if has_property(_KEY_CRYPTO):
+            secret = get_string(_KEY_CRYPTO)
+            env.update(re.findall(r"\$\{?(\w+)", secret))
+            set_property(_KEY_CRYPTO, os.path.expandvars(secret))
+            stats.append(__stat(get_string(_KEY_CRYPTO)))
+
+        __env_used.clear()
+        __yaml_update(props)
+        env.update(__env_used)
+
+        probe = None
+        if not has_property("ignis.container.provider"):
+            probe = __stat(shutil.which("singularity") or "")
+            set_property("ignis.container.provider", "singularity" if _check_singularity() else "docker")
+
+        if ok and cache:
+            __cache_save(sources, stats, env, probe)
 
     if not has_property("ignis.wdir"):
         set_property("ignis.wdir", os.getcwd())
 
-    if has_property(_KEY_CRYPTO):
-        set_property(_KEY_CRYPTO, os.path.expandvars(get_string(_KEY_CRYPTO)))
-
     if not has_property("ignis.submitter.env.TZ") or \
             not has_property("ignis.driver.env.TZ") or \
             not has_property("ignis.executor.env.TZ"):
@@ -220,8 +355,6 @@ def load_config(path):
     if not has_property("ignis.submitter.binds./tmp"):
         set_property("ignis.submitter.binds./tmp","/tmp")
 
-    __yaml_update(props)
-
     return ok or (path is not None and os.path.exists(path))
 
 
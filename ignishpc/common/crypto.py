@@ -0,0 +1,82 @@
+import os
+import base64
+import hashlib
+import functools
+import subprocess
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    CRYPTO_ERROR = None
+except Exception as ex:
+    CRYPTO_ERROR = ex
+
+# Same format as 'openssl aes-256-cbc -pbkdf2 -a': base64("Salted__" + salt + ciphertext)
+# with key and iv derived using PBKDF2-HMAC-SHA256 and 10000 iterations.
+_MAGIC = b"Salted__"
+_ITERATIONS = 10000
+
+
+def _read_password(kfile):
+    # openssl -kfile only uses the first line of the file
+    with open(kfile, "rb") as file:
+        line = file.readline()
+    return line[:-1] if line.endswith(b"\n") else line
+
+
+def _pbkdf2(password, salt):
+    key_iv = hashlib.pbkdf2_hmac("sha256", password, salt, _ITERATIONS, 48)
+    return key_iv[:32], key_iv[32:]
+
+
+# a secret decrypted again in the same process does not derive its key twice
+_derive = functools.lru_cache(maxsize=None)(_pbkdf2)
+
+
+def _b64(raw):
+    data = base64.b64encode(raw).decode("utf-8")
+    return "\n".join(data[i:i + 64] for i in range(0, len(data), 64))
+
+
+def _openssl(value, kfile, mode):
+    cmd = ["openssl", "aes-256-cbc", "-pbkdf2", "-a", mode, "-kfile", kfile]
+    if mode == "-d":
+        value += "\n"
+    result = subprocess.run(cmd, input=value, capture_output=True, encoding="utf-8", check=True).stdout
+    return result.strip() if mode == "-e" else result
+
+
+def encrypt(values, kfile):
+    if CRYPTO_ERROR is not None:
+        return [_openssl(value, kfile, "-e") for value in values]
+
+    password = _read_password(kfile)
+    result = list()
+    for value in values:
+        # a fresh salt, and so key and iv, for every value or equal secrets would have equal ciphertexts
+        salt = os.urandom(8)
+        key, iv = _pbkdf2(password, salt)
+        padder = padding.PKCS7(128).padder()
+        data = padder.update(value.encode("utf-8")) + padder.finalize()
+        encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+        result.append(_b64(_MAGIC + salt + encryptor.update(data) + encryptor.finalize()))
+    return result
+
+
+def decrypt(values, kfile):
+    if CRYPTO_ERROR is not None:
+        return [_openssl(value, kfile, "-d") for value in values]
+
+    password = _read_password(kfile)
+    result = list()
+    for value in values:
+        raw = base64.b64decode("".join(value.split()))
+        if not raw.startswith(_MAGIC):
+            raise ValueError("bad magic number")
+        key, iv = _derive(password, raw[8:16])
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        unpadder = padding.PKCS7(128).unpadder()
+        data = unpadder.update(decryptor.update(raw[16:]) + decryptor.finalize()) + unpadder.finalize()
+        result.append(data.decode("utf-8"))
+    return result
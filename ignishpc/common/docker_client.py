@@ -0,0 +1,28 @@
+import functools
+
+import docker
+
+from ignishpc.common import configuration
+
+_POOL_SIZE = 32
+
+
+def _client(pool_size, version):
+    return docker.from_env(version=version, max_pool_size=pool_size)
+
+
+@functools.lru_cache(maxsize=None)
+def get():
+    # The API version is negotiated with the engine unless ignis.container.docker.api pins it, newer engines
+    # reject old versions
+    if configuration.has_property("ignis.container.docker.api"):
+        return _client(_POOL_SIZE, configuration.get_string("ignis.container.docker.api"))
+    return _client(_POOL_SIZE, "auto")
+
+
+def dedicated():
+    """
+    A client with its own connection for a long streaming call (build, push), so concurrent streams do not hold the
+    connections of the shared client. The caller closes it.
+    """
+    return _client(1, get().api.api_version)
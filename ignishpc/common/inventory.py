@@ -0,0 +1,69 @@
+import re
+import fnmatch
+
+
+def compile_patterns(patterns):
+    """
+    Join wildcard patterns in a single regex, None if there are no patterns.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:" + fnmatch.translate(pat) + ")" for pat in patterns))
+
+
+def has_labels(img, labels):
+    img_labels = img.labels or dict()
+    for label in labels:
+        key, _, value = label.partition("=")
+        if key not in img_labels or (value and img_labels[key] != value):
+            return False
+    return True
+
+
+class Inventory:
+    """
+    Images of the docker daemon from a single listing, indexed by tag, id and parent.
+    """
+
+    def __init__(self, client, labels=None, all=False):
+        filters = {"label": labels} if labels else None
+        self.images = client.images.list(filters=filters, all=all)
+        self.by_id = {img.id: img for img in self.images}
+        self.by_tag = {tag: img.id for img in self.images for tag in img.tags}
+        self.children = dict()
+        for img in self.images:
+            parent = img.attrs.get("Parent")
+            if parent:
+                self.children[parent] = self.children.get(parent, 0) + 1
+
+    def tagged(self):
+        return [img for img in self.images if img.tags]
+
+    def untagged(self):
+        return [img for img in self.images if not img.tags]
+
+    def matching(self, regex):
+        if regex is None:
+            return self.tagged()
+        return [img for img in self.images if any(regex.match(tag) for tag in img.tags)]
+
+    def parent(self, img):
+        return self.by_id.get(img.attrs.get("Parent"))
+
+    def dangling(self, accept=lambda img: True):
+        """
+        Untagged images without children and their untagged parents. Every image is visited once, the listing must
+        include the intermediate layers (all=True).
+        """
+        seen = set()
+        result = list()
+        for img in self.images:
+            if img.tags or img.id in self.children or not accept(img):
+                continue
+            while img is not None and img.id not in seen:
+                seen.add(img.id)
+                result.append(img)
+                img = self.parent(img)
+                if img is not None and (img.tags or not accept(img)):
+                    img = None
+        return result
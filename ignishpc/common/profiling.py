@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+import atexit
+import contextlib
+
+enabled = os.getenv("IGNIS_PROFILE_STARTUP", "") not in ("", "0")
+_origin = time.perf_counter()
+_records = list()
+
+
+@contextlib.contextmanager
+def timed(name):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _records.append((name, start - _origin, time.perf_counter() - start))
+
+
+def report():
+    print("Startup profile:          START(ms)  ELAPSED(ms)", file=sys.stderr)
+    for name, start, elapsed in _records:
+        print(" ", name.ljust(22), f"{start * 1000:10.2f}", f"{elapsed * 1000:12.2f}", file=sys.stderr)
+    print(" ", "total".ljust(22), f"{0:10.2f}", f"{(time.perf_counter() - _origin) * 1000:12.2f}", file=sys.stderr)
+
+
+if enabled:
+    atexit.register(report)
@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def check_cycles(graph):
+    pending = {name: len(deps) for name, deps in graph.items()}
+    children_of = children(graph)
+    ready = [name for name, n in pending.items() if n == 0]
+    while ready:
+        name = ready.pop()
+        del pending[name]
+        for child in children_of[name]:
+            pending[child] -= 1
+            if pending[child] == 0:
+                ready.append(child)
+    if pending:
+        raise RuntimeError("dependency loop in " + ", ".join(sorted(pending)))
+
+
+def children(graph):
+    result = {name: list() for name in graph}
+    for name, deps in graph.items():
+        for dep in deps:
+            result[dep].append(name)
+    return result
+
+
+def schedule(graph, parallel, task, cores=1, batch=False, keep_going=False):
+    """
+    Run task(name, cores) as soon as all the dependencies of a node are done, at most parallel at the same time.
+    The cores are shared among the tasks that run at the same time and task returns False when it fails. With
+    batch, the nodes that are ready at the same time are sent together to task(names, cores), which returns the
+    names that failed. With keep_going, a failure only stops the nodes that depend on it. Returns the failed nodes.
+    """
+    pending = {name: set(deps) for name, deps in graph.items()}
+    children_of = children(graph)
+    ready = sorted(name for name, deps in pending.items() if len(deps) == 0)
+    running = dict()
+    busy = 0
+    used = 0
+    failed = list()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        while running or (ready and (keep_going or not failed)):
+            while ready and (keep_going or not failed) and busy < parallel:
+                # running tasks keep their cores, only the free ones are shared among the new tasks
+                starting = min(parallel - busy, len(ready))
+                share = max(1, (cores - used) // starting)
+                n = starting if batch else 1
+                names, ready = tuple(ready[:n]), ready[n:]
+                if batch:
+                    future = executor.submit(task, list(names), share)
+                else:
+                    future = executor.submit(lambda name, c: [] if task(name, c) else [name], names[0], share)
+                running[future] = (names, share * len(names))
+                busy += len(names)
+                used += share * len(names)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                names, reserved = running.pop(future)
+                busy -= len(names)
+                used -= reserved
+                try:
+                    errors = set(future.result())
+                except Exception as ex:
+                    for name in names:
+                        print("  " + name + "...ERROR", str(ex), flush=True)
+                    errors = set(names)
+                for name in names:
+                    if name in errors:
+                        failed.append(name)
+                        continue
+                    for child in children_of[name]:
+                        pending[child].discard(name)
+                        if len(pending[child]) == 0:
+                            ready.append(child)
+    return failed
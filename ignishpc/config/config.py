@@ -29,9 +29,9 @@ def _check_config(path):
 
 
 def _check_docker():
-    import docker
+    from ignishpc.common import docker_client
     try:
-        info = docker.from_env().version()
+        info = docker_client.get().version()
         if "Version" in info:
             return info["Version"]
         return "OK"
@@ -263,6 +263,8 @@ def cli():
                               nargs="+", help='Path core folders', default=[])
     images_build.add_argument('--platform', dest='platform', action='store',
                               help='Create ignis images for one or more platforms, requires buildx.')
+    images_build.add_argument('-j', '--jobs', dest='jobs', action='store', metavar='n', type=int,
+                              help='Maximum number of images built at the same time, default number of cores')
     common_arguments(images_build, registry=True, namespace=True)
 
     images_singularity = subparsers_images.add_parser("singularity",
@@ -448,7 +450,8 @@ def cli():
                          version=args.version,
                          default_registry=default_registry,
                          namespace=namespace,
-                         platform=args.platform)
+                         platform=args.platform,
+                         jobs=args.jobs)
         elif args.action == "singularity":
             images.singularity(name=args.image,
                                output=args.output,
@@ -1,15 +1,16 @@
 import datetime
-import fnmatch
 import os
 import re
 import shutil
 import tempfile
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from distutils.version import StrictVersion
 
 import docker
 import docker.errors
 
+from ignishpc.common import inventory
+
 try:
     import git
 
@@ -74,7 +75,7 @@ def push(yes, builders, version, whitelist, blacklist, default_registry, namespa
 
 
 def build(sources, local_sources, ignore_folders, version_filters, custom_images, bases, full, save_logs, version_tags,
-          version, default_registry, namespace, platform):
+          version, default_registry, namespace, platform, jobs=None):
     with tempfile.TemporaryDirectory(prefix="ignis") as wd:
         core_list = list()
         version_map = dict()
@@ -231,57 +232,43 @@ def build(sources, local_sources, ignore_folders, version_filters, custom_images
                 __createDockerfile(wd, img[0], img[1:], custom_version, default_registry, namespace, i))
 
         build_list.sort(key=lambda x: x["order"])
+        __dependencies(build_list, default_registry, namespace)
 
         print("Images:")
-        order = None
         for build in build_list:
-            if build["order"] != order:
-                print("  ---(" + str(build["order"]) + ")---")
-            order = build["order"]
-            print("  " + build["name"] + ":" + build["version"])
-
-        build_list.append({
-            "order": None
-        })
+            print("  " + build["name"] + ":" + build["version"], end="")
+            if build["deps"]:
+                print(" <- " + ", ".join(sorted(build["deps"])), end="")
+            print()
 
         print("Build:")
         image_list = list()
-        with ThreadPoolExecutor() as executor:
-            wait_list = list()
-            order = build_list[0]["order"]
-            for build in build_list:
-                if build["order"] != order:
-                    error = None
-                    for info, wait in wait_list:
-                        log = os.path.join(os.getcwd(), "ignisbuild-" + info["id"] + ".log")
-                        try:
-                            print("  " + info["name"] + ":" + info["version"], end=" ", flush=True)
-                            image_list.append((info, wait.result()))
-                            print("SUCCESS")
-                            if save_logs:
-                                shutil.copy(info["log"], log)
-                        except Exception as ex:
-                            print("FAILED, check " + log)
-                            shutil.copy(info["log"], log)
-                            error = ex
-                    if error:
-                        print("Aborting")
-                        raise error
-                    wait_list.clear()
-                order = build["order"]
-                if order is None:
-                    break
-                wait_list.append((build, executor.submit(
-                    __docker_build,
-                    name=build["name"],
-                    path=build["path"],
-                    dockerfile=build["dockerfile"],
-                    log=build["log"],
-                    version=build["version"],
-                    default_registry=default_registry,
-                    namespace=namespace,
-                    platform=platform
-                )))
+
+        def build_image(build):
+            return __docker_build(
+                name=build["name"],
+                path=build["path"],
+                dockerfile=build["dockerfile"],
+                log=build["log"],
+                version=build["version"],
+                default_registry=default_registry,
+                namespace=namespace,
+                platform=platform
+            )
+
+        def done(info, wait):
+            log = os.path.join(os.getcwd(), "ignisbuild-" + info["id"] + ".log")
+            try:
+                image_list.append((info, wait.result()))
+                print("  " + info["name"] + ":" + info["version"] + " SUCCESS", flush=True)
+                if save_logs:
+                    shutil.copy(info["log"], log)
+            except Exception:
+                print("  " + info["name"] + ":" + info["version"] + " FAILED, check " + log, flush=True)
+                shutil.copy(info["log"], log)
+                raise
+
+        __schedule(build_list, jobs if jobs else (os.cpu_count() or 1), build_image, done)
         print("Build end")
         if version_tags:
             print("Setting additional version tag:")
@@ -347,11 +334,116 @@ def singularity(name, output, host, default_registry, platform, force):
         raise RuntimeError("singularity fails with error " + str(exit_code) + "\n" + err)
 
 
+def __schedule(build_list, workers, task, done):
+    pending = {build["id"]: set(build["deps"]) for build in build_list}
+    builds = {build["id"]: build for build in build_list}
+    children = {id: list() for id in builds}
+    for build in build_list:
+        for dep in build["deps"]:
+            children[dep].append(build["id"])
+    ready = [build["id"] for build in build_list if len(build["deps"]) == 0]
+    running = dict()
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while running or (ready and error is None):
+            while ready and error is None:
+                id = ready.pop(0)
+                running[executor.submit(task, builds[id])] = id
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                id = running.pop(future)
+                try:
+                    done(builds[id], future)
+                except Exception as ex:
+                    error = ex
+                    continue
+                for child in children[id]:
+                    pending[child].discard(id)
+                    if len(pending[child]) == 0:
+                        ready.append(child)
+    if error:
+        print("Aborting")
+        raise error
+    if any(pending[id] for id in pending):
+        raise RuntimeError("dependency loop in " + ", ".join(sorted(id for id in pending if pending[id])))
+
+
+def __parents(dockerfile, buildargs):
+    lines = list()
+    with open(dockerfile) as file:
+        newline = True
+        for line in file:
+            line = line.strip()
+            scape = line.endswith("\\")
+            if scape:
+                line = line[:-1]
+            if newline:
+                lines.append(line)
+            else:
+                lines[-1] += " " + line
+            newline = not scape
+
+    args = dict()
+    stages = set()
+    parents = set()
+
+    def expand(value):
+        for key, arg in list(buildargs.items()) + list(args.items()):
+            value = value.replace("${" + key + "}", arg).replace("$" + key, arg)
+        return value
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        cmd = fields[0].upper()
+        if cmd == "ARG" and "=" in fields[1]:
+            key, value = fields[1].split("=", 1)
+            args.setdefault(key, value.strip("\"'"))
+        elif cmd == "FROM":
+            fields = [field for field in fields[1:] if not field.startswith("--")]
+            if fields[0] not in stages:
+                parents.add(expand(fields[0]))
+            if len(fields) == 3 and fields[1].upper() == "AS":
+                stages.add(fields[2])
+        elif cmd in ("COPY", "ADD"):
+            for field in fields[1:]:
+                if field.startswith("--from="):
+                    image = field[len("--from="):]
+                    if image not in stages and not image.isdigit():
+                        parents.add(expand(image))
+    return parents
+
+
+def __dependencies(build_list, default_registry, namespace):
+    # each image waits only for the images that appear in its FROM and COPY --from lines, when a reference can not
+    # be resolved the image waits for all images with a lower order
+    names = {build["name"] + ":" + build["version"]: build["id"] for build in build_list}
+    for build in build_list:
+        parents = __parents(build["dockerfile"], {
+            "REGISTRY": default_registry,
+            "NAMESPACE": namespace,
+            "TAG": ":" + build["version"],
+        })
+        if any("$" in parent for parent in parents):
+            build["deps"] = {other["id"] for other in build_list if other["order"] < build["order"]}
+        else:
+            build["deps"] = {names[parent] for parent in parents if parent in names and names[parent] != build["id"]}
+
+
 def __getImages(client, version, default_registry, namespace, whitelist, blacklist, none=False):
     labels = ["ignis"] if version is None else ["ignis=" + version]
     prefix = default_registry + namespace
-    imgs = client.images.list(name=prefix + "*", filters={"label": labels})
-    ref_names = list()
+    if none:
+        # a single listing with the layers serves the tagged images and the dangling chains
+        index = inventory.Inventory(client, all=True)
+        imgs = [img for img in index.tagged() if inventory.has_labels(img, labels)]
+    else:
+        index = inventory.Inventory(client, labels=labels)
+        imgs = index.tagged()
+    imgs = [img for img in imgs if any(tag.startswith(prefix) for tag in img.tags)]
+
+    ref_names = set()
     white_tags = set()
     black_tags = set()
     result = list()
@@ -361,20 +453,15 @@ def __getImages(client, version, default_registry, namespace, whitelist, blackli
         for tag in img.attrs['RepoTags']:
             if "/" in tag:
                 tag = tag.split("/")[-1]
-            if ":" in tag:
-                ref_names.append(tag.split(":")[0])
-            else:
-                ref_names.append(tag)
+            ref_names.add(tag.split(":")[0])
+    ref_names = sorted(ref_names)
 
     def prepare_tag(lst, tags):
         if lst is not None:
-            lst2 = list()
-            for name in lst:
-                if wildcard_s.search(name):
-                    lst2.extend(fnmatch.filter(ref_names, name))
-                else:
-                    lst2.append(name)
-            lst = lst2
+            pattern = inventory.compile_patterns([name for name in lst if wildcard_s.search(name)])
+            lst = [name for name in lst if not wildcard_s.search(name)]
+            if pattern is not None:
+                lst.extend(name for name in ref_names if pattern.match(name))
             for name in lst:
                 if ":" in name:
                     tags.add(name)
@@ -395,29 +482,8 @@ def __getImages(client, version, default_registry, namespace, whitelist, blackli
                 result.append((img.id, tag, __getDate(img)))
 
     if none:
-        imgs = client.images.list(filters={"label": labels})
-        root_nones = list(filter(lambda img: len(img.attrs['RepoTags']) == 0, imgs))
-        layers = client.images.list(filters={"label": labels}, all=True)
-        layer_map = dict()
-        for layer in layers:
-            layer_map[layer.id] = layer
-        nones = list()
-        while len(root_nones) > 0:
-            none = root_nones.pop()
-            nones.append(none)
-            parent_id = none.attrs['Parent']
-            if not parent_id or parent_id not in layer_map:
-                continue
-            parent = layer_map[parent_id]
-            if len(parent.attrs['RepoTags']) == 0:
-                root_nones.append(parent)
-
-        for img in nones:
-            if len(img.tags) > 0:
-                for tag in img.tags:
-                    result.append((img.id, tag))
-            else:
-                result.append((img.id, None, __getDate(img)))
+        for img in index.dangling(lambda img: inventory.has_labels(img, labels)):
+            result.append((img.id, None, __getDate(img)))
 
     return result
 
@@ -1,18 +1,28 @@
 import os
 import re
+import json
 import tempfile
 import shutil
 import fnmatch
 import shlex
 import textwrap
 import subprocess
+import threading
+import time
+import functools
 from collections import namedtuple
 
-import git
 import docker
 import docker.errors
 
 from ignishpc.common import configuration
+from ignishpc.common import docker_client
+from ignishpc.common import scheduler
+from ignishpc.images import cache
+from ignishpc.images import context
+from ignishpc.images import journal
+from ignishpc.images import telemetry
+from ignishpc.images import sources as src_cache
 
 
 def _replace_all(s, vars):
@@ -40,15 +50,19 @@ def _ignore_hidden(path, names):
     return set(hidden)
 
 
-def _dump_log(buildlog, path, msg=None):
-    # Remove ANSI color codes from the string.
-    strip = re.compile('\033\\[([0-9]+)(;[0-9]+)*m')
+# ANSI color codes
+_ANSI = re.compile('\033\\[([0-9]+)(;[0-9]+)*m')
+
+
+def _dump_log(buildlog, path, msg=None, record=None):
+    if record is not None:
+        record.logfile = path
     with open(path, "w") as file:
         for raw in buildlog:
             if isinstance(raw, dict) and 'stream' in raw:
-                file.write(re.sub(strip, '', raw['stream']))
+                file.write(_ANSI.sub('', raw['stream']))
             elif isinstance(raw, str):
-                file.write(re.sub(strip, '', raw))
+                file.write(_ANSI.sub('', raw))
         if msg is not None:
             file.write(msg)
 
@@ -72,8 +86,9 @@ def _parse_dockerfile(folder, subpath, name):
     requires = set()
     args = set()
     labels = {}
+    copies = list()
     for line in lines:
-        if any(line.upper().startswith(prefix) for prefix in ["FROM", "LABEL", "ARG", "COPY"]):
+        if any(line.upper().startswith(prefix) for prefix in ["FROM", "LABEL", "ARG", "COPY", "ADD"]):
             fields = shlex.split(line, posix=False)[1:]
             try:
                 if line[0].upper() == "F":
@@ -84,7 +99,7 @@ def _parse_dockerfile(folder, subpath, name):
                     for label in fields:
                         key, value = label.split("=")
                         labels[key] = value[1:-1]
-                elif line[0].upper() == "A":
+                elif line[:3].upper() == "ARG":
                     tag = fields[0] if '=' not in fields[0] else fields[0].split("=")[0]
                     args.add(tag)
                 else:
@@ -92,11 +107,28 @@ def _parse_dockerfile(folder, subpath, name):
                         if field.startswith("--from"):
                             requires.add(fields[0].split("=")[1])
                             break
+                    else:
+                        copies.extend(_copy_sources(line))
             except Exception as ex:
                 print("warn: " + line + " is ignored by parser, " + str(ex))
+                copies.append(".")
+
+    return namedtuple("Dockerfile", "folder, path, subpath, name requires args labels copies"
+                      )(folder, path, subpath, name, requires, args, labels, copies)
 
-    return namedtuple("Dockerfile", "folder, path, subpath, name requires args labels"
-                      )(folder, path, subpath, name, requires, args, labels)
+
+def _copy_sources(line):
+    # Context paths used by a COPY/ADD instruction, '.' when they can not be known
+    body = line.split(maxsplit=1)[1].strip()
+    while body.startswith("--"):
+        body = body.split(maxsplit=1)[1].strip()
+    if body.startswith("<<"):
+        return []
+    if body.startswith("["):
+        fields = json.loads(body)
+    else:
+        fields = shlex.split(body)
+    return [src for src in fields[:-1] if "://" not in src]
 
 
 def _create_dockerfile(path, name, cores, core_libs, build_args):
@@ -131,20 +163,84 @@ def _create_dockerfile(path, name, cores, core_libs, build_args):
     return _parse_dockerfile(folder, "", name)
 
 
-def _build(name, path, dockerfile, build_args, labels, arch, logfile, debug):
+def _build_graph(dockerfiles, images_name, build_args):
+    image_names = {image: name for name, image in images_name.items()}
+    graph = dict()
+    for name, dockerfile in dockerfiles.items():
+        deps = set()
+        for rawdep in dockerfile.requires:
+            dep = image_names.get(_replace_all(rawdep, build_args))
+            if dep is not None and dep != name:
+                deps.add(dep)
+        graph[name] = deps
+    return graph
+
+
+def _image_id(name):
+    try:
+        return docker_client.get().images.get(name).id
+    except docker.errors.ImageNotFound:
+        return None
+
+
+def _image_size(name):
     try:
-        client = docker.from_env()
+        return docker_client.get().images.get(name).attrs.get("Size")
+    except docker.errors.ImageNotFound:
+        return None
 
-        image, buildlog = client.images.build(
-            path=path,
+
+def _split_tag(name):
+    if ":" in name and name.rindex(":") > name.rfind("/"):
+        return name.rsplit(":", 1)
+    return name, None
+
+
+def _retag(image_id, name):
+    try:
+        image = docker_client.get().images.get(image_id)
+    except docker.errors.ImageNotFound:
+        return False
+    repository, tag = _split_tag(name)
+    return image.tag(repository, tag=tag)
+
+
+def _build(name, path, dockerfile, build_args, labels, arch, logfile, debug, record, tar=None):
+    buildlog = list()
+    client = docker_client.dedicated()
+    try:
+        if tar is not None:
+            source = dict(fileobj=record.count(tar), custom_context=True)
+        else:
+            source = dict(path=path)
+
+        # the daemon answers when the whole context is received
+        start = time.monotonic()
+        stream = client.api.build(
+            **source,
             tag=name,
             dockerfile=dockerfile,
             labels=labels,
             platform=arch,
-            buildargs=build_args
+            buildargs=build_args,
+            decode=True
         )
+        record.uploaded(start)
+
+        image_id = None
+        for chunk in stream:
+            buildlog.append(chunk)
+            record.log(chunk)
+            if "error" in chunk:
+                raise docker.errors.BuildError(chunk["error"], buildlog)
+            if "aux" in chunk and "ID" in chunk["aux"]:
+                image_id = chunk["aux"]["ID"]
+            elif "stream" in chunk and chunk["stream"].startswith("Successfully built "):
+                image_id = chunk["stream"].split()[-1]
+        if image_id is None:
+            raise docker.errors.BuildError("Unknown", buildlog)
         if debug:
-            _dump_log(buildlog, logfile)
+            _dump_log(buildlog, logfile, record=record)
     except docker.errors.BuildError as ex:
         manifest_error = re.compile(".*manifest for (.*) not found.*")
         msg = ex.msg
@@ -156,50 +252,126 @@ def _build(name, path, dockerfile, build_args, labels, arch, logfile, debug):
         result = manifest_error.search(msg)
         if result:
             msg += "\n" + result.group(1) + " required, use -s/--sources to add the Dockerfile"
-        _dump_log(ex.build_log, logfile, msg=msg)
+        _dump_log(ex.build_log, logfile, msg=msg, record=record)
         return False
+    finally:
+        client.close()
 
     return True
 
 
-def _buildx(name, path, dockerfile, build_args, labels, arch, logfile, debug):
-    result = subprocess.run(["docker", "buildx", "version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if result.returncode != 0:
-        raise RuntimeError(result.stdout.decode("utf-8"))
+_buildx_lock = threading.Lock()
+
 
-    result = subprocess.run(["docker", "buildx", "inspect", "ignishpc"], capture_output=True)
-    if result.returncode != 0:
-        result = subprocess.run(["docker", "buildx", "create", "--name", "ignishpc"],
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+def _buildx_setup():
+    with _buildx_lock:
+        result = subprocess.run(["docker", "buildx", "version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         if result.returncode != 0:
             raise RuntimeError(result.stdout.decode("utf-8"))
 
+        result = subprocess.run(["docker", "buildx", "inspect", "ignishpc"], capture_output=True)
+        if result.returncode != 0:
+            result = subprocess.run(["docker", "buildx", "create", "--name", "ignishpc"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if result.returncode != 0:
+                raise RuntimeError(result.stdout.decode("utf-8"))
+
+
+def _cache_specs(values, name, export):
+    # 'registry' stores the cache next to the image, a path is a local cache folder and anything else is a raw
+    # buildx cache specification
+    specs = list()
+    for value in values:
+        if value == "registry":
+            spec = "type=registry,ref=" + _split_tag(name)[0] + ":buildcache"
+        elif "=" in value:
+            spec = value
+        else:
+            folder = os.path.join(os.path.abspath(value), re.sub(r"[^\w.-]", "_", _split_tag(name)[0]))
+            if not export and not os.path.isdir(folder):
+                continue
+            spec = ("type=local,dest=" if export else "type=local,src=") + folder
+        if export and "mode=" not in spec:
+            spec += ",mode=max"
+        specs.append(spec)
+    return specs
+
+
+def _buildx(name, path, dockerfile, build_args, labels, arch, logfile, debug, record,
+            cache_from=(), cache_to=(), no_cache=False):
+    _buildx_setup()
+
     raw_build_args = sum([["--build-arg", arg + "=" + val] for arg, val in build_args.items()], [])
     raw_labels = sum([["--label", lab + "=" + val] for lab, val in labels.items()], [])
+    raw_cache = sum([["--cache-from", spec] for spec in _cache_specs(cache_from, name, False)], [])
+    raw_cache += sum([["--cache-to", spec] for spec in _cache_specs(cache_to, name, True)], [])
 
     result = subprocess.run(["docker", "buildx", "build",
                              "--builder", "ignishpc",
                              "--file", dockerfile,
-                             "--no-cache",
                              "--platform", arch,
                              "--progress", "plain",
                              "--push",
                              "--tag", name,
-                             "."] + raw_build_args + raw_labels,
+                             "."] + (["--no-cache"] if no_cache else []) + raw_build_args + raw_labels + raw_cache,
                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=path)
+    record.buildx_log(result.stdout.decode("utf-8"))
 
     if debug or result.returncode != 0:
-        _dump_log([{'stream': result.stdout.decode("utf-8")}], logfile)
+        _dump_log([{'stream': result.stdout.decode("utf-8")}], logfile, record=record)
 
     return result.returncode == 0
 
 
+def _bake(targets, arch, debug, wd, cache_from=(), cache_to=(), no_cache=False):
+    # Several images in a single buildx bake, BuildKit shares the work between them. When it fails, the images
+    # are built one by one to know which ones failed, the completed steps are reused from the builder cache.
+    _buildx_setup()
+    bake = dict()
+    for i, target in enumerate(targets):
+        bake["t" + str(i)] = {
+            "context": target["path"],
+            "dockerfile": target["dockerfile"],
+            "args": target["build_args"],
+            "labels": target["labels"],
+            "tags": [target["name"]],
+            "platforms": arch.split(",") if arch else [],
+            "cache-from": _cache_specs(cache_from, target["name"], False),
+            "cache-to": _cache_specs(cache_to, target["name"], True),
+            "no-cache": no_cache,
+        }
+    fd, file = tempfile.mkstemp(prefix="bake-", suffix=".json", dir=wd)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"target": bake}, f)
+
+    result = subprocess.run(["docker", "buildx", "bake",
+                             "--builder", "ignishpc",
+                             "--file", file,
+                             "--progress", "plain",
+                             "--push"] + list(bake.keys()),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = result.stdout.decode("utf-8")
+
+    for i, target in enumerate(targets):
+        target["record"].buildx_log(output, "t" + str(i))
+        if debug or result.returncode != 0:
+            _dump_log([{'stream': output}], target["logfile"], record=target["record"])
+
+    if result.returncode != 0 and len(targets) > 1:
+        return [target["name"] for target in targets
+                if not _buildx(**{key: target[key] for key in ("name", "path", "dockerfile", "build_args",
+                                                                "labels", "logfile", "record")},
+                               arch=arch, debug=debug, cache_from=cache_from, cache_to=cache_to,
+                               no_cache=no_cache)]
+    return [target["name"] for target in targets] if result.returncode != 0 else []
+
+
 def _run(args):
     build_args = {
         "REGISTRY": args.registry,
         "NAMESPACE": args.namespace,
         "TAG": args.tag,
-        "BUILD_CORES": str(os.cpu_count()) if args.jobs is None else args.jobs,
+        "BUILD_CORES": str(os.cpu_count()) if args.jobs is None else str(args.jobs),
         "VERSION": "dev" if args.tag == "latest" else args.tag
     }
 
@@ -221,18 +393,9 @@ def _run(args):
         print("Sources:")
         sources = list()
 
-        for i, src in enumerate(args.sources):
-            target = next(new_folder)
-            os.mkdir(target)
-            if ":" in src:
-                field = src.split()
-                if len(field) == 2:
-                    git.Repo.clone_from(field[0], target, branch=field[1])
-                else:
-                    git.Repo.clone_from(field[0], target)
-                shutil.rmtree(os.path.join(target, ".git"), ignore_errors=True)
-            else:
-                shutil.copytree(src, target, dirs_exist_ok=True, ignore=_ignore_hidden)
+        targets = [next(new_folder) for _ in args.sources]
+        snapshots = src_cache.fetch(args.sources, targets, _ignore_hidden)
+        for src, target in zip(args.sources, targets):
             if "Dockerfiles" in os.listdir(target):
                 print(" ", src)
                 sources.append(target)
@@ -318,59 +481,197 @@ def _run(args):
 
         print()
         print("Images:")
-        images = set()
         images_name = dict()
         for name, dockerfile in dockerfiles.items():
             image = build_args["REGISTRY"] + build_args["NAMESPACE"] + dockerfile.name + build_args["TAG"]
-            images.add(image)
             images_name[name] = image
             print(" ", image)
 
         print()
-        build = set()
         print("Build:")
-        max_it = len(dockerfiles) + 1
-        while len(build) != len(dockerfiles):
-            max_it -= 1
-            for name, dockerfile in dockerfiles.items():
-                if images_name[name] in build:
-                    continue
-                if max_it == 0:
-                    raise RuntimeError("dependency loop in" + name)
-                local = dockerfile.labels.get("ignis.build.context", False)
-                if not local:
-                    dock_path = os.path.relpath(dockerfile.path, os.path.dirname(dockerfile.folder))
-                    build_args["DOCK_DIR"] = os.path.dirname(dock_path) + "/"
-                    build_args["RELPATH"] = build_args["DOCK_DIR"]  # legacy
-
-                deps = [_replace_all(rawdep, build_args) for rawdep in dockerfile.requires]
-                if any(dep in images and dep not in build and dep != images_name[name] for dep in deps):
+        graph = _build_graph(dockerfiles, images_name, build_args)
+        scheduler.check_cycles(graph)
+
+        if args.bake and not args.buildx:
+            raise RuntimeError("--bake requires --buildx")
+        buildkit = dict(cache_from=args.cache_from, cache_to=args.cache_to, no_cache=args.no_cache)
+        if args.dry_run:
+            f = lambda *a, **k: True
+        elif args.buildx:
+            f = functools.partial(_buildx, **buildkit)
+        else:
+            f = _build
+
+        use_cache = not args.no_cache and not args.dry_run and not args.buildx
+        index = cache.load_index("build") if use_cache else dict()
+        index_lock = threading.Lock()
+        contexts = context.Contexts(wd)
+        context_files = dict()
+        report = telemetry.Telemetry(graph, images_name)
+        build_journal = journal.Journal(args.resume, persist=not args.dry_run)
+        build_journal.start(graph, images_name, dict(zip(args.sources, snapshots)))
+
+        def node_key(name, cores):
+            path, _, node_args, labels, files = node_inputs(name, cores)
+            base = cache.image_key(dockerfiles[name], path,
+                                   {key: val for key, val in node_args.items() if key != "BUILD_CORES"},
+                                   labels, dict(), files, args.arch)
+            return build_journal.key(name, images_name[name], base, graph[name])
+
+        def resumed(name, cores, record):
+            if not build_journal.completed(name, node_key(name, cores)):
+                return False
+            print(" ", images_name[name], end="...OK (resumed)\n", flush=True)
+            record.finish("resumed")
+            build_journal.update(name, "resumed")
+            return True
+
+        def build_node(name, cores):
+            record = report.record(name)
+            record.begin()
+            if resumed(name, cores, record):
+                return True
+            status = "error"
+            try:
+                status = build_image(name, cores, record)
+            finally:
+                record.finish(status)
+                build_journal.update(name, status)
+            return status != "error"
+
+        def build_batch(names, cores):
+            pending = list()
+            targets = list()
+            for name in names:
+                record = report.record(name)
+                record.begin()
+                if resumed(name, cores, record):
                     continue
-
-                print(" ", images_name[name], end="...", flush=True)
-                logfile = dockerfile.name + ".log"
-
-                if args.dry_run:
-                    f = lambda *a, **k: True
-                elif args.buildx:
-                    f = _buildx
-                else:
-                    f = _build
-
-                ok = f(name=images_name[name],
-                       path=os.path.dirname(dockerfile.folder) if not local else os.path.dirname(dockerfile.path),
-                       dockerfile=dockerfile.path if not local else os.path.basename(dockerfile.path),
-                       build_args={key: val for key, val in build_args.items() if key in dockerfile.args},
-                       labels={"ignis.version": build_args["VERSION"]},
-                       arch=args.arch,
-                       logfile=logfile,
-                       debug=args.log)
-                if ok:
-                    print("OK")
+                pending.append(name)
+                path, dockerfile, node_args, labels, _ = node_inputs(name, cores)
+                targets.append(dict(name=images_name[name], path=path, dockerfile=dockerfile,
+                                    build_args=node_args, labels=labels, logfile=dockerfiles[name].name + ".log",
+                                    record=record))
+            errors = [target["name"] for target in targets]
+            try:
+                if targets and not args.dry_run:
+                    errors = _bake(targets, args.arch, args.log, wd, **buildkit)
                 else:
-                    print("ERROR", "->", logfile)
-                    raise RuntimeError("Build abort")
-
-                build.add(images_name[name])
+                    errors = []
+            finally:
+                for name, target in zip(pending, targets):
+                    ok = target["name"] not in errors
+                    target["record"].finish("built" if ok else "error")
+                    build_journal.update(name, "built" if ok else "error")
+                    if ok:
+                        print(" ", target["name"], end="...OK\n", flush=True)
+                    else:
+                        print(" ", target["name"], end="...ERROR -> " + target["logfile"] + "\n", flush=True)
+            return [name for name in pending if images_name[name] in errors]
+
+        def node_inputs(name, cores):
+            dockerfile = dockerfiles[name]
+            node_args = dict(build_args)
+            node_args["BUILD_CORES"] = str(cores)
+            local = dockerfile.labels.get("ignis.build.context", False)
+            if not local:
+                dock_path = os.path.relpath(dockerfile.path, os.path.dirname(dockerfile.folder))
+                node_args["DOCK_DIR"] = os.path.dirname(dock_path) + "/"
+                node_args["RELPATH"] = node_args["DOCK_DIR"]  # legacy
+
+            path = os.path.dirname(dockerfile.folder) if not local else os.path.dirname(dockerfile.path)
+            node_args = {key: val for key, val in node_args.items() if key in dockerfile.args}
+            labels = {"ignis.version": build_args["VERSION"]}
+
+            # only the paths read by COPY/ADD are sent to the daemon, buildx reads the context folder itself
+            dockerfile_path = os.path.relpath(dockerfile.path, path)
+            files = None
+            if f is _build:
+                copies = tuple(_replace_all(src, node_args) for src in dockerfile.copies)
+                if (path, copies, dockerfile_path) not in context_files:
+                    context_files[(path, copies, dockerfile_path)] = context.files(path, copies, dockerfile_path)
+                files = context_files[(path, copies, dockerfile_path)]
+            if not local and files is None:
+                dockerfile_path = dockerfile.path
+            return path, dockerfile_path, node_args, labels, files
+
+        def build_image(name, cores, record):
+            dockerfile = dockerfiles[name]
+            path, dockerfile_path, node_args, labels, files = node_inputs(name, cores)
+
+            def image_key():
+                # external bases are only local after the first build pulls them, the reference is used until then
+                parents = dict()
+                for rawdep in sorted(dockerfile.requires):
+                    dep = _replace_all(rawdep, build_args)
+                    parents[dep] = _image_id(dep) or dep
+                return cache.image_key(dockerfile, path,
+                                       {key: val for key, val in node_args.items() if key != "BUILD_CORES"},
+                                       labels, parents, files, args.arch)
+
+            if use_cache:
+                key = image_key()
+                with index_lock:
+                    image_id = index.get(key)
+                if image_id is not None and _retag(image_id, images_name[name]):
+                    print(" ", images_name[name], end="...OK (cached)\n", flush=True)
+                    return "cached"
+
+            logfile = dockerfile.name + ".log"
+            extra = dict()
+            if files is not None:
+                extra["tar"] = contexts.stream(path, files)
+            ok = f(name=images_name[name],
+                   path=path,
+                   dockerfile=dockerfile_path,
+                   build_args=node_args,
+                   labels=labels,
+                   arch=args.arch,
+                   logfile=logfile,
+                   debug=args.log,
+                   record=record,
+                   **extra)
+            if ok:
+                if use_cache:
+                    image_id = _image_id(images_name[name])
+                    if image_id is not None:
+                        # the next build looks up the key of the bases pulled by this one
+                        pulled = image_key()
+                        with index_lock:
+                            index[key] = image_id
+                            index[pulled] = image_id
+                if f is _build:
+                    record.size = _image_size(images_name[name])
+                print(" ", images_name[name], end="...OK\n", flush=True)
+            else:
+                print(" ", images_name[name], end="...ERROR -> " + logfile + "\n", flush=True)
+            return "built" if ok else "error"
+
+        # only the contexts shared by several images are stored to be sent again
+        if f is _build:
+            for name in graph:
+                path, _, _, _, files = node_inputs(name, 1)
+                if files is not None:
+                    contexts.expect(path, files)
+
+        try:
+            failed = scheduler.schedule(graph, max(1, args.parallel), build_batch if args.bake else build_node,
+                                        cores=int(build_args["BUILD_CORES"]), batch=args.bake,
+                                        keep_going=args.keep_going)
+        finally:
+            if use_cache:
+                cache.save_index("build", index)
+            if args.report is not None:
+                report.save(args.report)
+        if not args.dry_run:
+            report.summary()
+        if failed:
+            skipped = [name for name in graph if report.record(name).status is None]
+            if skipped:
+                print()
+                print("Skipped:")
+                for name in sorted(skipped):
+                    print(" ", images_name[name])
+            raise RuntimeError("Build abort, use --resume to continue from the failed images")
 
         print("Build End")
@@ -0,0 +1,69 @@
+import os
+import json
+import hashlib
+import functools
+
+from ignishpc.common import configuration
+
+
+def _index_path(name):
+    return os.path.join(os.path.dirname(configuration.USER_CONFIG), name + "-cache.json")
+
+
+def load_index(name):
+    try:
+        with open(_index_path(name)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_index(name, index):
+    path = _index_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _walk(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), path)
+
+
+@functools.lru_cache(maxsize=None)
+def context_hash(path, files=None):
+    h = hashlib.sha256()
+    for rel in _walk(path) if files is None else files:
+        file = os.path.join(path, rel)
+        if os.path.isdir(file) and not os.path.islink(file):
+            continue
+        h.update(rel.encode("utf-8") + b"\0")
+        if os.path.islink(file):
+            h.update(os.readlink(file).encode("utf-8"))
+        else:
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def image_key(dockerfile, context, build_args, labels, parents, files=None, platform=None):
+    h = hashlib.sha256()
+    with open(dockerfile.path, "rb") as file:
+        h.update(file.read())
+    h.update(json.dumps({
+        "requires": sorted(dockerfile.requires),
+        "args": sorted(dockerfile.args),
+        "labels": dockerfile.labels,
+        "context": context_hash(context, files),
+        "build_args": build_args,
+        "image_labels": labels,
+        "parents": parents,
+        "platform": platform,
+    }, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
@@ -19,6 +19,7 @@ def setup(subparsers):
     build = actions.add_parser("build", **desc("Build images"), formatter_class=SmartFormatter,
                                epilog="""Examples:
                                      | $ ignishpc images build --buildx --arch linux/amd64,linux/arm64,linux/ppc64le
+                                     | $ ignishpc images build --buildx --bake --cache-from registry --cache-to registry
                                      | $ ignishpc images build -g coreA -g coreB --core-images --name -
                                      | $ ignishpc images build -a -s URL""")
 
@@ -44,15 +45,33 @@ def setup(subparsers):
                        help="build optional images")
     build.add_argument("-j", "--jobs", action="store", metavar="n", type=int,
                        help="try to set a limit of cores to build an image, default auto")
+    build.add_argument("-P", "--parallel", action="store", metavar="n", type=int, default=1,
+                       help="number of images built at the same time, cores are shared among them, default 1")
     build.add_argument("--ignore", action="store", metavar="folder", nargs="+",
                        help="ignore images that contains wildcard pattern in name", default=[])
     build.add_argument("--enable", action="store", metavar="folder", nargs="+",
                        help="enable optional images that contains wildcard pattern in name", default=[])
+    build.add_argument("--no-cache", action="store_true", default=False,
+                       help="rebuild images even if their Dockerfile, context, arguments and parents are unchanged")
+    build.add_argument("--resume", action="store_true", default=False,
+                       help="skip the images that were built by the last run with the same inputs")
+    build.add_argument("--keep-going", action="store_true", default=False,
+                       help="when an image fails, build all the images that do not depend on it")
+    build.add_argument("--report", action="store", metavar="file",
+                       help="write a JSON report with the timings, cache hits and size of every image")
     build.add_argument("--dry-run", action="store_true", default=False,
                        help="perform a simulation of the build with checks but without creating any images")
     build.add_argument("--buildx", action="store_true", default=False,
                        help="perform multi-architecture building using Buildx. The result will be pushed and removed. "
                             "The docker binary binary must be available in PATH and the buildx plugin installed")
+    build.add_argument("--bake", action="store_true", default=False,
+                       help="with --buildx, send the images that are ready at the same time in a single buildx bake")
+    build.add_argument("--cache-from", action="append", metavar="src", default=[],
+                       help="with --buildx, import the BuildKit cache from a folder, 'registry' to use a buildcache "
+                            "tag next to each image or a buildx cache specification")
+    build.add_argument("--cache-to", action="append", metavar="dst", default=[],
+                       help="with --buildx, export the BuildKit cache, same values as --cache-from. RUN cache mounts "
+                            "are kept in the ignishpc builder between runs")
 
     _list = actions.add_parser("list", **desc("Display images"))
     _list.add_argument("-p", "--pattern", action="append", metavar="str", default=[],
@@ -69,12 +88,17 @@ def setup(subparsers):
                     help="force image removal", default=False)
     rm.add_argument("-y", "--yes", action="store_true",
                     help="skip confirmation prompt for image removal", default=False)
+    rm.add_argument("-P", "--parallel", action="store", metavar="n", type=int, default=4,
+                    help="number of images removed at the same time, default 4")
 
     push = actions.add_parser("push", **desc("Push images"))
     push.add_argument("-p", "--pattern", action="append", metavar="str", default=[],
                       help="filter images by wildcard pattern")
     push.add_argument("-y", "--yes", action="store_true",
                       help="skip confirmation prompt for image push", default=False)
+    push.add_argument("-P", "--parallel", action="store", metavar="n", type=int, default=1,
+                      help="number of tags pushed at the same time, shared layers are uploaded only once, "
+                           "default 1")
 
     pull = actions.add_parser("pull", **desc("Pull a image"))
     pull.add_argument("image", action="store", help="image name")
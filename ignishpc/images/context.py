@@ -0,0 +1,156 @@
+import os
+import re
+import fnmatch
+import tarfile
+import tempfile
+import threading
+
+from docker.utils.build import PatternMatcher
+
+_GLOB = re.compile(r"[*?\[]")
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _dockerignore(root):
+    try:
+        with open(os.path.join(root, ".dockerignore")) as file:
+            return [line.strip() for line in file if line.strip() and not line.startswith("#")]
+    except OSError:
+        return []
+
+
+def _expand(root, pattern):
+    # COPY/ADD source to the paths it matches, wildcards follow filepath.Match and are applied by level
+    matches = [""]
+    for part in pattern.split("/"):
+        found = list()
+        for base in matches:
+            folder = os.path.join(root, base)
+            if not _GLOB.search(part):
+                if os.path.lexists(os.path.join(folder, part)):
+                    found.append(os.path.join(base, part))
+            elif os.path.isdir(folder):
+                found.extend(os.path.join(base, name) for name in sorted(os.listdir(folder))
+                             if fnmatch.fnmatchcase(name, part))
+        matches = found
+    return matches
+
+
+def _add_tree(root, rel, files):
+    files.add(rel)
+    path = os.path.join(root, rel)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for base, dirs, names in os.walk(path):
+            for name in dirs + names:
+                files.add(os.path.relpath(os.path.join(base, name), root))
+
+
+def files(root, sources, dockerfile):
+    """
+    Paths of the context that the sources of COPY/ADD can read, without the ones excluded by .dockerignore.
+    Returns None when the whole context is required.
+    """
+    selected = set()
+    for src in sources:
+        if "$" in src:
+            return None
+        src = os.path.normpath(src.lstrip("/"))
+        if src == "." or src.startswith(".."):
+            return None
+        for rel in _expand(root, src):
+            _add_tree(root, rel, selected)
+
+    ignore = _dockerignore(root)
+    if ignore:
+        matcher = PatternMatcher(ignore)
+        selected = {rel for rel in selected if not matcher.matches(rel)}
+    selected.add(dockerfile)
+    if os.path.exists(os.path.join(root, ".dockerignore")):
+        selected.add(".dockerignore")
+    return tuple(sorted(selected))
+
+
+class _Sink:
+
+    def __init__(self):
+        self.chunks = list()
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _tar(root, files):
+    sink = _Sink()
+    with tarfile.open(fileobj=sink, mode="w|") as tar:
+        for rel in files:
+            info = tar.gettarinfo(os.path.join(root, rel), arcname=rel)
+            if not info.isreg():
+                tar.addfile(info)
+                yield sink.drain()
+                continue
+            # as tar.addfile but the data is yielded in chunks, a large file is never held in memory
+            header = info.tobuf(tar.format, tar.encoding, tar.errors)
+            tar.fileobj.write(header)
+            with open(os.path.join(root, rel), "rb") as file:
+                left = info.size
+                while left > 0:
+                    data = file.read(min(left, _CHUNK_SIZE))
+                    if not data:
+                        raise OSError("unexpected end of data: " + rel)
+                    tar.fileobj.write(data)
+                    left -= len(data)
+                    yield sink.drain()
+            blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            tar.offset += len(header) + blocks * tarfile.BLOCKSIZE
+            yield sink.drain()
+    yield sink.drain()
+
+
+class Contexts:
+    """
+    Pruned build contexts, the tar is streamed while it is generated. A context expected by several images is
+    also kept in wd, so the other images send the stored tar.
+    """
+
+    def __init__(self, wd):
+        self.wd = wd
+        self.tars = dict()
+        self.uses = dict()
+        self.lock = threading.Lock()
+
+    def expect(self, root, files):
+        key = (root, files)
+        self.uses[key] = self.uses.get(key, 0) + 1
+
+    def stream(self, root, files):
+        key = (root, files)
+        with self.lock:
+            path = self.tars.get(key)
+        if path is not None:
+            return self._read(path)
+        if self.uses.get(key, 0) <= 1:
+            return _tar(root, files)
+        return self._write(key, root, files)
+
+    def _read(self, path):
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(_CHUNK_SIZE), b""):
+                yield chunk
+
+    def _write(self, key, root, files):
+        fd, path = tempfile.mkstemp(prefix="context-", suffix=".tar", dir=self.wd)
+        with os.fdopen(fd, "wb") as file:
+            for chunk in _tar(root, files):
+                file.write(chunk)
+                yield chunk
+        with self.lock:
+            self.tars.setdefault(key, path)
@@ -1,19 +1,35 @@
 import os
+import sys
+import errno
+import contextlib
 
 import docker
 import docker.errors
 import docker.types
-import fnmatch
 import datetime
 import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from ignishpc.common import configuration
-from ignishpc.images import build
+from ignishpc.common import docker_client
+from ignishpc.common import inventory
+from ignishpc.common import scheduler
+from ignishpc.images import cache
+
+_SAVE_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _build(args):
+    # build requires git, load it only when it is used
+    from ignishpc.images import build
+    return build._run(args)
 
 
 def _run(args):
     return {
-        "build": build._run,
+        "build": _build,
         "list": _list,
         "rm": _rm,
         "push": _push,
@@ -22,17 +38,10 @@ def _run(args):
 
 
 def _get_images(patterns, untagged=False):
-    client = docker.from_env()
-
-    ignis_images = client.images.list(filters={"label": ["ignis.version"]})
-    images = list()
-
-    for entry in ignis_images:
-        has_pattern = any([any([fnmatch.fnmatch(tag, pat) for tag in entry.tags]) for pat in patterns])
-
-        if (len(entry.tags) > 0 and (len(patterns) == 0 or has_pattern)) or (len(entry.tags) == 0 and untagged):
-            images.append(entry)
-
+    index = inventory.Inventory(docker_client.get(), labels=["ignis.version"])
+    images = index.matching(inventory.compile_patterns(patterns))
+    if untagged:
+        images += index.untagged()
     return images
 
 
@@ -75,23 +84,113 @@ def _rm(args):
     _print_images(images)
 
     if _ask_before(args):
-        to_remove = list()
+        client = docker_client.get()
+        pattern = inventory.compile_patterns(args.pattern)
+        refs = dict()
         for img in images:
-            created = _image_date(img)
-            created = created if created is not None else datetime.datetime.min
             if len(img.tags) > 0:
-                tags = [tag for tag in img.tags if any([fnmatch.fnmatch(tag, pat) for pat in args.pattern])]
-                for tag in tags:
-                    to_remove.append((created, tag))
+                tags = [tag for tag in img.tags if pattern is not None and pattern.match(tag)]
+                if len(tags) > 0:
+                    refs[img.id] = tags
             else:
-                to_remove.append((created, img.short_id))
-        client = docker.from_env()
-
-        for _, tag in sorted(to_remove, key=lambda t: t[0], reverse=True):
+                refs[img.id] = [img.id]
+
+        # an image is removed after the selected images built on top of it
+        index = inventory.Inventory(client, all=True)
+        graph = _removal_graph(index, refs)
+
+        attempted = set()
+        deleted = list()
+
+        def remove(img_id, _):
+            attempted.add(img_id)
+            for ref in refs[img_id]:
+                try:
+                    deleted.extend(client.images.remove(image=ref, force=args.force) or [])
+                except docker.errors.APIError as ex:
+                    print(ref, "can't be removed:", ex.explanation, flush=True)
+                    return False
+            return True
+
+        failed = scheduler.schedule(graph, max(1, args.parallel), remove, keep_going=True)
+        skipped = [img_id for img_id in graph if img_id not in attempted]
+        for img_id in skipped:
+            print(" ".join(refs[img_id]), "can't be removed: a dependent image was not removed")
+
+        # untagged parent layers of the removed images that docker kept, a layer still used by others is kept
+        for layer in _orphan_layers(index, refs, set(attempted) - set(failed)):
             try:
-                client.images.remove(image=tag, force=args.force)
-            except docker.errors.APIError as ex:
-                print(tag, "can't be removed:", ex.explanation)
+                deleted.extend(client.images.remove(image=layer) or [])
+            except docker.errors.APIError:
+                pass
+        removed = {entry["Deleted"] for entry in deleted if "Deleted" in entry}
+        print("Removed", len(graph) - len(failed) - len(skipped), "of", len(graph), "images, reclaimed",
+              _size_format(sum(_layer_size(index, img_id) for img_id in removed)))
+
+
+def _orphan_layers(index, refs, removed):
+    layers = list()
+    for img_id in removed:
+        parent = index.by_id[img_id].attrs.get("Parent") if img_id in index.by_id else None
+        while parent in index.by_id and parent not in refs and not index.by_id[parent].tags and parent not in layers:
+            layers.append(parent)
+            parent = index.by_id[parent].attrs.get("Parent")
+    return layers
+
+
+def _layer_size(index, img_id):
+    # space of the image without its parent, the parent is counted when it is removed too
+    img = index.by_id.get(img_id)
+    if img is None:
+        return 0
+    parent = index.by_id.get(img.attrs.get("Parent"))
+    return max(0, img.attrs.get("Size", 0) - (parent.attrs.get("Size", 0) if parent is not None else 0))
+
+
+def _removal_graph(index, refs):
+    # nearest selected ancestor of every layer, each parent chain is walked once
+    nearest = dict()
+
+    def selected_ancestor(img_id):
+        chain = list()
+        parent = index.by_id[img_id].attrs.get("Parent") if img_id in index.by_id else None
+        while parent and parent not in refs and parent not in nearest and parent in index.by_id:
+            chain.append(parent)
+            parent = index.by_id[parent].attrs.get("Parent")
+        if parent in refs:
+            found = parent
+        elif parent in nearest:
+            found = nearest[parent]
+        else:
+            found = None
+        for layer in chain:
+            nearest[layer] = found
+        return found
+
+    graph = {img_id: set() for img_id in refs}
+    for img_id in refs:
+        ancestor = selected_ancestor(img_id)
+        if ancestor is not None:
+            graph[ancestor].add(img_id)
+    return graph
+
+
+def _registry(tag):
+    host = tag.split("/")[0]
+    if "/" in tag and ("." in host or ":" in host or host == "localhost"):
+        return host
+    return "docker.io"
+
+
+def _push_tag(tag):
+    uploaded = dict()
+    with contextlib.closing(docker_client.dedicated()) as client:
+        for line in client.images.push(tag, stream=True, decode=True):
+            if 'errorDetail' in line:
+                raise RuntimeError(line['errorDetail']['message'])
+            if line.get("status") == "Pushing" and "current" in line.get("progressDetail", {}):
+                uploaded[line["id"]] = line["progressDetail"]["current"]
+    return sum(uploaded.values())
 
 
 def _push(args):
@@ -100,37 +199,120 @@ def _push(args):
     _print_images(images)
 
     if _ask_before(args):
-        client = docker.from_env()
+        pending = list()
         for img in images:
+            layers = img.attrs.get("RootFS", {}).get("Layers", [])
             for tag in img.tags:
-                print(tag, end="...", flush=True)
-                for line in client.images.push(tag, stream=True, decode=True):
-                    if 'errorDetail' in line:
-                        print("ERROR")
-                        raise RuntimeError(line['errorDetail']['message'])
-                print("PUSHED")
+                registry = _registry(tag)
+                pending.append((tag, {(registry, layer) for layer in layers}))
+        # Images with less layers are usually the base of the others, they go first so that their layers
+        # are already in the registry when the others are pushed.
+        pending.sort(key=lambda entry: len(entry[1]))
+
+        parallel = max(1, args.parallel)
+        pushed = set()
+        busy = set()
+        running = dict()
+        failed = list()
+        total = 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            while pending or running:
+                for entry in list(pending):
+                    if len(running) >= parallel:
+                        break
+                    tag, layers = entry
+                    new = layers - pushed
+                    # a layer is never uploaded by two pushes at the same time
+                    if new & busy:
+                        continue
+                    pending.remove(entry)
+                    busy |= new
+                    running[executor.submit(_push_tag, tag)] = (tag, new, time.time())
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tag, new, tag_start = running.pop(future)
+                    busy -= new
+                    try:
+                        size = future.result()
+                    except Exception as ex:
+                        failed.append(tag)
+                        print(" ", tag, "ERROR:", getattr(ex, "explanation", None) or ex, flush=True)
+                        continue
+                    pushed |= new
+                    total += size
+                    print(" ", tag, "PUSHED", _size_format(size),
+                          "(" + _size_format(size / max(time.time() - tag_start, 1e-3)) + "/s)", flush=True)
+
+        elapsed = time.time() - start
+        tags = sum(len(img.tags) for img in images)
+        print("Push End:", tags - len(failed), "pushed,", len(failed), "failed,", _size_format(total), "uploaded in",
+              f"{elapsed:.1f}s", "(" + _size_format(total / max(elapsed, 1e-3)) + "/s)")
+        if failed:
+            raise RuntimeError("Push failed: " + " ".join(failed))
+
+
+def _pull_image(client, name):
+    # Docker Hub images are pulled through the mirror when there is one, upstream is the fallback
+    from ignishpc.services import registry
+    mirror = registry.mirror_address() if _registry(name) == "docker.io" else None
+    if mirror is not None:
+        repository = name[len("docker.io/"):] if name.startswith("docker.io/") else name
+        if "/" not in repository:
+            repository = "library/" + repository
+        if ":" not in repository and "@" not in repository:
+            repository += ":latest"
+        try:
+            image = client.images.pull(mirror + "/" + repository)
+            if "@" in name:
+                # the layers are already pulled, upstream only sends the manifest to reference the digest
+                image = client.images.pull(name)
+            elif ":" in name:
+                image.tag(*name.rsplit(":", 1))
+            else:
+                image.tag(name, "latest")
+            client.images.remove(mirror + "/" + repository)
+            print("pulled from mirror " + mirror)
+            return image
+        except docker.errors.APIError as ex:
+            print("warn: mirror " + mirror + " failed, " + str(ex.explanation) + ", pulling from upstream")
+    return client.images.pull(name)
 
 
 def _pull(args):
-    client = docker.from_env()
+    client = docker_client.get()
 
     if args.local:
         image = client.images.get(args.image)
     else:
         print("pulling image")
-        image = client.images.pull(args.image)
+        image = _pull_image(client, args.image)
         print("pull complete")
         if args.singularity is None:
             return
     target = os.path.abspath(args.singularity)
 
+    index = cache.load_index("sif")
+    if _sif_updated(index.get(target), image.id, target):
+        print("image already converted, " + args.singularity + " is up to date")
+        return
+
     with tempfile.TemporaryDirectory(prefix="ignis-build-") as wd:
         source = os.path.abspath(os.path.join(wd, "ignis.image"))
-        print("writing to disk")
-        with open(source, "wb") as file:
-            for chunk in image.save():
-                file.write(chunk)
-            file.flush()
+        errors = list()
+        stop = threading.Event()
+        writer = None
+        if _fifo_supported(client):
+            # the converter starts while the image is saved, the archive goes through a fifo
+            os.mkfifo(source, mode=0o600)
+            writer = threading.Thread(target=_stream_image, args=(image, source, stop, errors), daemon=True)
+            writer.start()
+        else:
+            print("writing to disk")
+            with open(source, "wb") as file:
+                for chunk in image.save(chunk_size=_SAVE_CHUNK_SIZE):
+                    file.write(chunk)
 
         print("converting image to singularity format")
         try:
@@ -147,7 +329,60 @@ def _pull(args):
             )
         except docker.errors.ContainerError as ex:
             raise RuntimeError(ex.stderr.decode("utf-8"))
-        print("image saved in " + args.singularity)
+        finally:
+            stop.set()
+            if writer is not None:
+                writer.join()
+        if errors:
+            raise errors[0]
+
+    st = os.stat(target)
+    index[target] = {"image": image.id, "mtime": st.st_mtime_ns, "size": st.st_size}
+    cache.save_index("sif", index)
+    print("image saved in " + args.singularity)
+
+
+def _fifo_supported(client):
+    # a host fifo can only be bind mounted when the daemon runs natively on this linux host, Docker Desktop
+    # and remote daemons do not share it with the container
+    if not sys.platform.startswith("linux") or not client.api.base_url.startswith("http+docker://"):
+        return False
+    try:
+        return "Docker Desktop" not in client.info().get("OperatingSystem", "")
+    except docker.errors.APIError:
+        return False
+
+
+def _stream_image(image, path, stop, errors):
+    try:
+        # wait for the converter without blocking, it may exit without opening the fifo
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as ex:
+                if ex.errno != errno.ENXIO:
+                    raise
+                if stop.wait(0.1):
+                    return
+        os.set_blocking(fd, True)
+        with open(fd, "wb") as fifo:
+            for chunk in image.save(chunk_size=_SAVE_CHUNK_SIZE):
+                fifo.write(chunk)
+    except BrokenPipeError:
+        pass
+    except Exception as ex:
+        errors.append(ex)
+
+
+def _sif_updated(entry, image_id, target):
+    if entry is None or entry["image"] != image_id:
+        return False
+    try:
+        st = os.stat(target)
+    except OSError:
+        return False
+    return entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size
 
 
 def _image_date(img):
@@ -175,3 +410,13 @@ def _date_format(elapsed):
         if seconds > pseconds:
             value = int(seconds / pseconds)
             return "{} {}{} ago".format(value, pname, 's' if value > 1 else '')
+
+
+def _size_format(size):
+    if size < 1024:
+        return f"{int(size)}B"
+    for unit in ("KB", "MB", "GB"):
+        size /= 1024
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+    return f"{size / 1024:.1f}TB"
@@ -0,0 +1,66 @@
+import os
+import json
+import hashlib
+import threading
+
+from ignishpc.common import configuration
+
+
+def _path():
+    return os.path.join(os.path.dirname(configuration.USER_CONFIG), "build-journal.json")
+
+
+class Journal:
+    """
+    State of the last images build: the resolved graph, the source snapshots and the inputs of every node that
+    was built. With resume, nodes that succeeded with the same inputs are not built again.
+    """
+
+    def __init__(self, resume, persist=True):
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.keys = dict()
+        self.previous = dict()
+        if resume:
+            try:
+                with open(_path()) as file:
+                    self.previous = json.load(file).get("nodes", dict())
+            except (OSError, ValueError):
+                print("warn: no build journal found, building from the beginning")
+        # an interrupted resume must not forget the nodes that were not visited yet
+        self.data = {"nodes": dict(self.previous)}
+
+    def start(self, graph, images_name, sources):
+        self.data["graph"] = {name: sorted(deps) for name, deps in graph.items()}
+        self.data["images"] = images_name
+        self.data["sources"] = sources
+        self.save()
+
+    def key(self, name, image, base_key, deps):
+        # inputs of the node and of all its dependencies
+        h = hashlib.sha256((image + "\0" + base_key).encode("utf-8"))
+        for dep in sorted(deps):
+            h.update(("\0" + self.keys.get(dep, "")).encode("utf-8"))
+        with self.lock:
+            self.keys[name] = h.hexdigest()
+        return self.keys[name]
+
+    def completed(self, name, key):
+        node = self.previous.get(name)
+        return node is not None and node["key"] == key and node["status"] in ("built", "cached", "resumed")
+
+    def update(self, name, status):
+        with self.lock:
+            self.data["nodes"][name] = {"key": self.keys.get(name), "status": status}
+        self.save()
+
+    def save(self):
+        if not self.persist:
+            return
+        path = _path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            tmp = path + ".tmp"
+            with open(tmp, "w") as file:
+                json.dump(self.data, file, indent=1, sort_keys=True)
+            os.replace(tmp, path)
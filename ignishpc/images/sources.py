@@ -0,0 +1,122 @@
+import os
+import errno
+import contextlib
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ignishpc.common import configuration
+
+_FICLONE = 0x40049409  # linux ioctl to share the extents of a file (reflink)
+_locks = dict()
+_locks_lock = threading.Lock()
+
+
+def _mirror_path(url):
+    name = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(os.path.dirname(configuration.USER_CONFIG), "sources", name + ".git")
+
+
+@contextlib.contextmanager
+def _lock(path):
+    # threads of this process and other processes that share the mirror
+    with _locks_lock:
+        lock = _locks.setdefault(path, threading.Lock())
+    with lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", "a") as file:
+            try:
+                import fcntl
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            yield
+
+
+def _mirror(url):
+    import git
+    path = _mirror_path(url)
+    if not os.path.exists(os.path.join(path, "HEAD")):
+        repo = git.Repo.init(path, bare=True)
+        repo.create_remote("origin", url)
+    else:
+        repo = git.Repo(path)
+        repo.remote("origin").set_url(url)
+    return repo
+
+
+def _shallow(repo):
+    # a new mirror only has the commits fetched with depth 1, it is complete once it is deepened
+    return os.path.exists(os.path.join(repo.git_dir, "shallow")) or not repo.git.for_each_ref()
+
+
+def _fetch(repo, ref):
+    import git
+    # Only the requested branch or tag is downloaded, a commit id may not be fetchable directly
+    depth = ["--depth", "1"] if _shallow(repo) else []
+    try:
+        repo.git.fetch(*depth, "--force", "origin", ref)
+        return repo.git.rev_parse("FETCH_HEAD")
+    except git.GitCommandError:
+        pass
+    try:
+        return repo.git.rev_parse("--verify", ref + "^{commit}")
+    except git.GitCommandError:
+        pass
+    deepen = ["--unshallow"] if os.path.exists(os.path.join(repo.git_dir, "shallow")) else []
+    repo.git.fetch(*deepen, "--force", "--tags", "origin", "+refs/heads/*:refs/remotes/origin/*")
+    return repo.git.rev_parse(ref + "^{commit}")
+
+
+def _checkout(url, ref, target):
+    with _lock(_mirror_path(url)):
+        repo = _mirror(url)
+        commit = _fetch(repo, ref if ref is not None else "HEAD")
+        repo.git.worktree("prune")
+        repo.git.worktree("add", "--detach", "--force", target, commit)
+        # the build context must not depend on the worktree location
+        os.remove(os.path.join(target, ".git"))
+        repo.git.worktree("prune")
+    return commit
+
+
+def _clone_file(src, dst):
+    # The snapshot must not change with the sources, a hardlink is only used for read-only files
+    if not os.stat(src).st_mode & 0o222:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    try:
+        import fcntl
+        with open(src, "rb") as fin, open(dst, "wb") as fout:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+        shutil.copystat(src, dst)
+        return dst
+    except (OSError, ImportError):
+        return shutil.copy2(src, dst)
+
+
+def _snapshot(src, target, ignore):
+    shutil.copytree(src, target, dirs_exist_ok=True, ignore=ignore, copy_function=_clone_file)
+
+
+def fetch(sources, folders, ignore, parallel=None):
+    """
+    Place every source in its folder, URLs are checked out from a persistent mirror that is only fetched
+    incrementally and local paths are reflinked when the filesystem allows it or copied. Returns the
+    commit of every URL source and None for paths.
+    """
+    def task(src, target):
+        os.makedirs(target, exist_ok=True)
+        if ":" in src:
+            field = src.split()
+            return _checkout(field[0], field[1] if len(field) == 2 else None, target)
+        _snapshot(src, target, ignore)
+
+    with ThreadPoolExecutor(max_workers=parallel or max(1, len(sources))) as executor:
+        futures = [executor.submit(task, src, target) for src, target in zip(sources, folders)]
+        return [future.result() for future in futures]
@@ -0,0 +1,182 @@
+import re
+import json
+import time
+
+_STEP = re.compile(r"^Step \d+/\d+ : (.*)")
+_BUILDX_STEP = re.compile(r"^#(\d+) (\[[^\]]+\] .*)")
+_BUILDX_END = re.compile(r"^#(\d+) (?:DONE ([\d.]+)s|(CACHED))")
+
+
+class Record:
+    """
+    Timings of a single image build, times are seconds since the start of the build.
+    """
+
+    def __init__(self, t0, name, image, deps):
+        self.t0 = t0
+        self.name = name
+        self.image = image
+        self.deps = sorted(deps)
+        self.start = None
+        self.end = None
+        self.status = None
+        self.upload = None
+        self.upload_bytes = None
+        self.size = None
+        self.logfile = None
+        self.steps = list()
+        self._step_start = None
+
+    def _now(self):
+        return time.monotonic() - self.t0
+
+    def begin(self):
+        self.start = self._now()
+
+    def finish(self, status):
+        self._close_step()
+        self.end = self._now()
+        self.status = status
+
+    def uploaded(self, start):
+        self.upload = time.monotonic() - start
+
+    def count(self, chunks):
+        self.upload_bytes = 0
+        for chunk in chunks:
+            self.upload_bytes += len(chunk)
+            yield chunk
+
+    def _close_step(self):
+        if self._step_start is not None:
+            self.steps[-1]["seconds"] = round(self._now() - self._step_start, 3)
+            self._step_start = None
+
+    def log(self, chunk):
+        # docker build stream, a step lasts until the next one starts
+        for line in chunk.get("stream", "").splitlines():
+            match = _STEP.match(line)
+            if match:
+                self._close_step()
+                self.steps.append({"instruction": match.group(1), "seconds": None, "cached": False})
+                self._step_start = self._now()
+            elif line.strip() == "---> Using cache" and self.steps:
+                self.steps[-1]["cached"] = True
+
+    def buildx_log(self, text, target=None):
+        # buildx plain progress, durations are reported by buildkit. Bake prefixes the steps with the target name
+        steps = dict()
+        for line in text.splitlines():
+            match = _BUILDX_STEP.match(line)
+            if match and target is not None and not match.group(2).startswith("[" + target + " "):
+                continue
+            if match and match.group(1) not in steps:
+                steps[match.group(1)] = {"instruction": match.group(2), "seconds": None, "cached": False}
+                continue
+            match = _BUILDX_END.match(line)
+            if match and match.group(1) in steps:
+                step = steps[match.group(1)]
+                if match.group(3):
+                    step["cached"] = True
+                    step["seconds"] = 0.0
+                else:
+                    step["seconds"] = float(match.group(2))
+        self.steps = list(steps.values())
+
+    def to_dict(self, ready):
+        hits = sum(1 for step in self.steps if step["cached"])
+        return {
+            "image": self.image,
+            "deps": self.deps,
+            "status": self.status,
+            "ready": _round(ready),
+            "start": _round(self.start),
+            "end": _round(self.end),
+            "queue_wait": _round(self.start - ready if self.start is not None and ready is not None else None),
+            "duration": _round(self.duration()),
+            "upload": {"seconds": _round(self.upload), "bytes": self.upload_bytes},
+            "cache": {"hits": hits, "misses": len(self.steps) - hits},
+            "size": self.size,
+            "log": self.logfile,
+            "steps": self.steps,
+        }
+
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+class Telemetry:
+
+    def __init__(self, graph, images_name):
+        self.t0 = time.monotonic()
+        self.graph = graph
+        self.records = {name: Record(self.t0, name, images_name[name], deps) for name, deps in graph.items()}
+
+    def record(self, name):
+        return self.records[name]
+
+    def _ready(self, name):
+        ends = [self.records[dep].end for dep in self.graph[name]]
+        if any(end is None for end in ends):
+            return None
+        return max(ends, default=0.0)
+
+    def critical_path(self):
+        # longest chain of build durations in the dependency graph
+        dist = dict()
+        prev = dict()
+
+        def visit(name):
+            if name not in dist:
+                best = None
+                for dep in self.graph[name]:
+                    visit(dep)
+                    if best is None or dist[dep] > dist[best]:
+                        best = dep
+                dist[name] = self.records[name].duration() + (dist[best] if best is not None else 0.0)
+                prev[name] = best
+            return dist[name]
+
+        for name in sorted(self.graph):
+            visit(name)
+        if not dist:
+            return [], 0.0
+        name = max(sorted(dist), key=lambda n: dist[n])
+        total = dist[name]
+        path = list()
+        while name is not None:
+            path.append(name)
+            name = prev[name]
+        return path[::-1], total
+
+    def report(self):
+        path, total = self.critical_path()
+        elapsed = max([r.end for r in self.records.values() if r.end is not None], default=0.0)
+        return {
+            "elapsed": _round(elapsed),
+            "critical_path": {"images": path, "seconds": _round(total)},
+            "images": {name: record.to_dict(self._ready(name)) for name, record in sorted(self.records.items())},
+        }
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def summary(self, top=5):
+        path, total = self.critical_path()
+        if not path:
+            return
+        print()
+        print("Critical path (" + format(total, ".1f") + "s):")
+        for name in path:
+            record = self.records[name]
+            print("  " + name, format(record.duration(), ".1f") + "s")
+            steps = sorted((s for s in record.steps if s["seconds"]), key=lambda s: s["seconds"], reverse=True)
+            for step in steps[:top]:
+                print("    " + format(step["seconds"], ".1f") + "s", step["instruction"][:80])
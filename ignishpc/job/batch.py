@@ -0,0 +1,151 @@
+import os
+import re
+import copy
+import json
+import shlex
+import argparse
+import tempfile
+
+from ignishpc.common import configuration
+from ignishpc.job import job
+from ignishpc.job import spec
+from ignishpc.job.relay import Relay
+
+# Spec keys that are resource property aliases of 'ignishpc run'
+_ALIASES = ["cores", "instances", "mem", "gpu", "img", "driver_cores", "driver_mem", "driver_img"]
+_JOB_ID = re.compile(r"job\s*(?:id)?\s*[:=]\s*(\S+)", re.IGNORECASE)
+
+
+def _read_specs(path):
+    with open(path) as file:
+        if path.endswith(".jsonl"):
+            specs = [json.loads(line) for line in file if line.strip()]
+        else:
+            specs = configuration.yaml.load(file)
+    if not isinstance(specs, list):
+        raise RuntimeError(path + " must contain a list of jobs")
+    return specs
+
+
+def _to_list(value):
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [f"{key}={val}" for key, val in value.items()]
+    if isinstance(value, str):
+        return [value]
+    return [str(entry) for entry in value]
+
+
+def _job_namespace(entry, debug):
+    if "command" not in entry:
+        raise RuntimeError("job without command: " + str(dict(entry)))
+    args = argparse.Namespace(
+        command=str(entry["command"]),
+        args=[str(arg) for arg in entry.get("args", [])],
+        name=entry.get("name"),
+        property=_to_list(entry.get("properties")),
+        env=_to_list(entry.get("env")),
+        bind=_to_list(entry.get("binds")),
+        interactive=False,
+        time=entry.get("time"),
+        static=entry.get("static"),
+        verbose=bool(entry.get("verbose", False)),
+        debug=debug,
+    )
+    for alias in _ALIASES:
+        setattr(args, alias, entry.get(alias, entry.get(alias.replace("_", "-"))))
+    return args
+
+
+def _script(commands, folder, parallel):
+    lines = ["run_job() {",
+             '  i=$1; shift',
+             '  if [ -f ' + shlex.quote(folder) + '/$i.options ]; then',
+             '    export IGNIS_OPTIONS="$(cat ' + shlex.quote(folder) + '/$i.options)"',
+             '  fi',
+             '  "$@" > ' + shlex.quote(folder) + '/$i.out 2>&1',
+             '  code=$?',
+             '  echo $code > ' + shlex.quote(folder) + '/$i.code',
+             '  echo "  job $i finished with code $code"',
+             "}"]
+    for i, cmd in enumerate(commands):
+        lines.append(f"while [ $(jobs -rp | wc -l) -ge {parallel} ]; do wait -n; done")
+        lines.append(f"run_job {i} " + " ".join(shlex.quote(arg) for arg in cmd) + " &")
+    lines.append("wait")
+    return "\n".join(lines) + "\n"
+
+
+def _job_id(output):
+    found = _JOB_ID.findall(output)
+    if found:
+        return found[-1]
+    lines = [line for line in output.splitlines() if line.strip()]
+    return lines[-1].strip() if lines else ""
+
+
+def _run(args):
+    specs = _read_specs(args.file)
+    base = copy.deepcopy(configuration.props)
+    binds = list()
+    spec_files = dict()
+    names = list()
+    commands = list()
+
+    with tempfile.TemporaryDirectory(prefix="ignis-batch-") as folder:
+        for i, entry in enumerate(specs):
+            # every job has its own properties, they are encoded and the configuration is restored
+            job_args = _job_namespace(entry, args.debug)
+            cmd = job._job_args(job_args)
+            names.append(job_args.name if job_args.name is not None else job_args.command)
+            # the job sees the same binds as a single submission
+            job._submitter_binds()
+            options, path = spec.options(f"/ignis-options/{i}.json")
+            prefix = ["env", "-u", "IGNIS_OPTIONS_FILE", "-u", "IGNIS_OPTIONS_ENCODING"]
+            if path is None:
+                with open(os.path.join(folder, f"{i}.options"), "w") as file:
+                    file.write(options.pop("IGNIS_OPTIONS"))
+            else:
+                spec_files[options["IGNIS_OPTIONS_FILE"]] = path
+                prefix += ["-u", "IGNIS_OPTIONS"]
+            prefix += [key + "=" + value for key, value in options.items()]
+            commands.append(prefix + ["bash", "ignis-submit"] + cmd)
+            if job_args.static is not None and job_args.static != "-" and os.path.exists(job_args.static):
+                binds.append(os.path.abspath(job_args.static))
+            configuration.props.clear()
+            configuration.props.update(copy.deepcopy(base))
+
+        for file in binds + [folder]:
+            configuration.set_property(f"ignis.submitter.binds.{file}", file)
+        for target, path in spec_files.items():
+            configuration.set_property(f"ignis.submitter.binds.{target}", path + ":ro")
+
+        script = os.path.join(folder, "batch.sh")
+        with open(script, "w") as file:
+            file.write(_script(commands, folder, max(1, args.parallel)))
+
+        print("Submitting", len(commands), "jobs:")
+        try:
+            job._submit([script], False, Relay(), entrypoint=("bash",))
+        except Exception as ex:
+            print("warning: batch session failed:", ex)
+
+        print()
+        print("JOB    CODE   NAME                  ID")
+        failed = 0
+        for i, name in enumerate(names):
+            try:
+                with open(os.path.join(folder, f"{i}.code")) as file:
+                    code = file.read().strip()
+                with open(os.path.join(folder, f"{i}.out"), errors="replace") as file:
+                    output = file.read()
+            except FileNotFoundError:
+                code, output = "-", ""
+            if code != "0":
+                failed += 1
+            print(str(i).ljust(6), code.ljust(6), str(name)[:20].ljust(21), _job_id(output) if code == "0" else "")
+            if code != "0" and output:
+                print("      " + output.strip().replace("\n", "\n      "))
+
+    if failed > 0:
+        raise RuntimeError(f"{failed} of {len(commands)} jobs could not be submitted")
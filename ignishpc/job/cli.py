@@ -8,7 +8,10 @@ def _cmd(args):
 
 
 def setup(subparsers):
-    parser = subparsers.add_parser("job", **desc("Manage jobs"))
+    parser = subparsers.add_parser("job", **desc("Manage jobs"), formatter_class=SmartFormatter,
+                                   epilog="""Note: with ignis.submitter.daemon.enabled=true, list, info and cancel reuse a
+                                     submitter container that is stopped after ignis.submitter.daemon.timeout
+                                     seconds (default 600) without use.""")
 
     actions = parser.add_subparsers(dest="action", title="Available Actions", metavar="<action>")
     actions.required = True
@@ -17,16 +20,43 @@ def setup(subparsers):
 
     _list = actions.add_parser("list", **desc("Display jobs"))
 
-    info = actions.add_parser("info", **desc("Get job info"))
-    info.add_argument("id", action="store", metavar="str",
+    info = actions.add_parser("info", **desc("Get job info"), formatter_class=SmartFormatter,
+                              epilog="""Examples:
+                                     | $ ignishpc job info myjob
+                                     | $ ignishpc job info job1 job2 -f state -f time -o csv
+                                     | $ ignishpc job info --state running -o ndjson --watch""")
+    info.add_argument("id", action="store", metavar="str", nargs="*",
                       help="job id")
-    info.add_argument("-f", "--field", action="store", metavar="str",
-                     help="show only a field of the job")
+    info.add_argument("-f", "--field", action="append", metavar="str", default=[],
+                      help="show only a field of the job, can be repeated")
+    info.add_argument("-a", "--all", action="store_true", default=False,
+                      help="get info of all jobs")
+    info.add_argument("-s", "--state", action="append", metavar="str", default=[],
+                      help="get info of the jobs in a state, can be repeated")
+    info.add_argument("-o", "--output", action="store", choices=["text", "table", "json", "ndjson", "csv"],
+                      default="text", help="output format, text is the ignis-submit output of a single job")
+    info.add_argument("-w", "--watch", action="store_true", default=False,
+                      help="keep querying the jobs and print only the ones that change")
+    info.add_argument("--interval", action="store", metavar="seconds", type=float, default=5,
+                      help="time between queries in watch mode, default 5")
 
     cancel = actions.add_parser("cancel", **desc("Cancel a job"))
     cancel.add_argument("id", action="store", metavar="str",
                         help="job id")
 
+    batch = actions.add_parser("submit-batch", **desc("Submit a list of jobs in a single submitter session"),
+                               formatter_class=SmartFormatter,
+                               epilog="""Job fields: command, args, name, env, binds, properties, time, static, verbose
+                                     and the resource aliases (cores, instances, mem, gpu, img, driver_cores,
+                                     driver_mem, driver_img).
+                                     Examples:
+                                     | $ ignishpc job submit-batch sweep.yaml
+                                     | $ ignishpc job submit-batch -P 16 sweep.jsonl""")
+    batch.add_argument("file", action="store", metavar="path",
+                       help="YAML list or JSONL file (.jsonl) with a job per entry")
+    batch.add_argument("-P", "--parallel", action="store", metavar="n", type=int, default=8,
+                       help="number of jobs submitted at the same time, default 8")
+
     return _cmd
 
 
@@ -62,6 +92,10 @@ def setup_run(subparsers):
                           "Use 'int' for a homogeneous cluster")
     run.add_argument("-v", "--verbose", action="store_true", default=False,
                      help="display detailed information about the job's execution")
+    run.add_argument("--line-buffered", action="store_true", default=False,
+                     help="write job output only at line boundaries (lines up to 64KiB)")
+    run.add_argument("--output-log", action="store", metavar="path",
+                     help="also store the job output in a gzip compressed file")
 
     props = run.add_argument_group("resource properties alias")
     props.add_argument("--cores", action="store", metavar="n", type=int,
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import subprocess
+
+from ignishpc.common import configuration
+from ignishpc.job import job
+from ignishpc.job.relay import Relay
+
+# A long-lived submitter is reused by the job commands that only query the submitter (list, info, cancel).
+# It is stopped after 'ignis.submitter.daemon.timeout' seconds without use and recreated when its image or
+# container options change. The working directory is not bound, the daemon is shared by every directory.
+_PREFIX = "ignishpc-submitter-"
+_TIMEOUT = 600
+_HEARTBEAT = "/ignis-daemon/heartbeat"
+_IDLE = 'touch {hb}; while [ $(( $(date +%s) - $(stat -c %Y {hb}) )) -lt {timeout} ]; do sleep 5; done'
+_EXEC = 'touch {hb}; "$@"; code=$?; touch {hb}; exit $code'
+
+
+def _timeout():
+    return int(configuration.get_string("ignis.submitter.daemon.timeout", _TIMEOUT))
+
+
+def _hash(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def _stable_binds(wdir, binds):
+    # the working directory defaults to the current one, a daemon that binds it would not be reused from another one
+    host = os.path.abspath(wdir)
+    return [bind for bind in binds if bind != host + ":" + host]
+
+
+def run(args, entrypoint=("bash", "ignis-submit"), relay=None):
+    if relay is None:
+        relay = Relay()
+    args = list(entrypoint) + args
+    wdir, env, binds = job._submitter_setup()
+    binds = _stable_binds(wdir, binds)
+    try:
+        if configuration.get_string("ignis.container.provider") == "singularity":
+            return_code = _singularity_exec(args, env, binds, relay)
+        else:
+            return_code = _docker_exec(args, env, binds, relay)
+    finally:
+        relay.close()
+
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, "")
+
+
+def _docker_exec(args, env, binds, relay):
+    import docker.errors
+    from ignishpc.common import docker_client
+
+    client = docker_client.get()
+    name = _PREFIX + str(os.getuid())
+    options = job._docker_args(None, binds)
+    timeout = _timeout()
+    # a tag pulled again points to another image
+    try:
+        image_id = client.images.get(options["image"]).id
+    except docker.errors.ImageNotFound:
+        image_id = None
+    key = _hash(image_id, options, timeout)
+
+    # a daemon that exits between the check and the exec is replaced once, the command has not started yet
+    for retry in (True, False):
+        container = _docker_daemon(client, name, key, options, timeout)
+        try:
+            exec_id = client.api.exec_create(container.id,
+                                             ["bash", "-c", _EXEC.format(hb=_HEARTBEAT), "bash"] + args,
+                                             environment=env)
+            output = client.api.exec_start(exec_id, stream=True)
+        except docker.errors.APIError as ex:
+            if not retry or ex.status_code not in (404, 409):
+                raise
+            continue
+        for chunk in output:
+            relay.write(chunk)
+        return client.api.exec_inspect(exec_id)["ExitCode"]
+
+
+def _docker_daemon(client, name, key, options, timeout):
+    import docker.errors
+
+    try:
+        container = client.containers.get(name)
+        if container.labels.get("ignis.daemon.hash") == key and container.status == "running":
+            # the heartbeat is renewed before the daemon is used, so its idle loop can not expire during the exec
+            try:
+                if container.exec_run(["touch", _HEARTBEAT]).exit_code == 0:
+                    return container
+            except docker.errors.APIError as ex:
+                if ex.status_code not in (404, 409):
+                    raise
+        container.remove(force=True)
+    except docker.errors.NotFound:
+        pass
+    except docker.errors.APIError as ex:
+        # an expired daemon is already being removed
+        if ex.status_code != 409:
+            raise
+
+    try:
+        return client.containers.run(
+            name=name,
+            command=["bash", "-c", _IDLE.format(hb=_HEARTBEAT, timeout=timeout)],
+            detach=True,
+            auto_remove=True,
+            labels={"ignis.daemon.hash": key},
+            tmpfs={os.path.dirname(_HEARTBEAT): "mode=1777"},
+            **options
+        )
+    except docker.errors.APIError as ex:
+        if ex.status_code != 409:
+            raise
+        # created by another command at the same time
+        return client.containers.get(name)
+
+
+def _singularity_instances():
+    result = subprocess.run(["singularity", "instance", "list", "--json"], capture_output=True, encoding="utf-8")
+    if result.returncode != 0:
+        return []
+    return [entry["instance"] for entry in json.loads(result.stdout).get("instances", [])]
+
+
+def _singularity_exec(args, env, binds, relay):
+    image = configuration.default_image()
+    options = job._singularity_args(None, binds)
+    timeout = _timeout()
+    try:
+        st = os.stat(image)
+        version = (st.st_ino, st.st_size, st.st_mtime_ns)
+    except OSError:
+        version = None
+    name = _PREFIX + _hash(image, version, options, timeout)
+    heartbeat = os.path.join(os.path.dirname(configuration.USER_CONFIG), "daemon", name)
+
+    instances = _singularity_instances()
+    for instance in instances:
+        if instance.startswith(_PREFIX) and instance != name:
+            subprocess.run(["singularity", "instance", "stop", instance], capture_output=True)
+
+    os.makedirs(os.path.dirname(heartbeat), exist_ok=True)
+    with open(heartbeat, "a"):
+        os.utime(heartbeat)
+
+    if name not in instances:
+        subprocess.run(["singularity", "instance", "start", "--cleanenv"] + options + [image, name],
+                       capture_output=True, check=True)
+        subprocess.Popen([sys.executable, "-m", "ignishpc.job.daemon", name, heartbeat, str(timeout)],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+
+    cmd = ["singularity", "exec", "--cleanenv"]
+    for key, val in env.items():
+        cmd.extend(["--env", f"{key}={val}"])
+    proc = subprocess.Popen(cmd + ["instance://" + name] + args,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    relay.pump(proc.stdout.fileno())
+    return_code = proc.wait()
+    os.utime(heartbeat)
+    return return_code
+
+
+def _watch(name, heartbeat, timeout):
+    # stops the singularity instance when it has not been used for timeout seconds
+    while True:
+        try:
+            idle = time.time() - os.stat(heartbeat).st_mtime
+        except FileNotFoundError:
+            idle = timeout
+        if idle >= timeout:
+            break
+        time.sleep(min(5.0, timeout - idle))
+        if name not in _singularity_instances():
+            return
+    subprocess.run(["singularity", "instance", "stop", name], capture_output=True)
+    try:
+        os.remove(heartbeat)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == "__main__":
+    _watch(sys.argv[1], sys.argv[2], float(sys.argv[3]))
@@ -0,0 +1,163 @@
+import os
+import json
+import socket
+import struct
+import selectors
+import threading
+import subprocess
+
+# Legacy protocol: one command at a time through the in/out/err/code files.
+PIPES = ["in", "out", "err", "code"]
+# Protocol v2: a unix socket where every message is a frame (type, length, payload).
+#   client -> R: json request {"cmd": "shell command"} or {"argv": [...]}, optional "cwd" and "env"
+#   server -> O/E: stdout/stderr chunks as they are produced, X: exit code
+# A connection can send several requests one after another, concurrent requests use different connections.
+SOCKET = "sock"
+_HEADER = struct.Struct("!cI")
+_CHUNK_SIZE = 64 * 1024
+
+
+def setup(tmp, set_bind):
+    os.mkfifo(os.path.join(tmp, PIPES[0]), mode=0o600)
+    os.mkfifo(os.path.join(tmp, PIPES[-1]), mode=0o600)
+
+    for p in PIPES + [SOCKET]:
+        set_bind(f"/ignis-pipe/{p}", os.path.join(tmp, p))
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(os.path.join(tmp, SOCKET))
+    os.chmod(os.path.join(tmp, SOCKET), 0o600)
+    server.listen()
+    return server
+
+
+def serve(tmp, server):
+    threading.Thread(target=_fifo_loop, args=(tmp,), daemon=True).start()
+    # a connection can stay open between requests, a thread for each one so idle clients never block the others
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=_serve_connection, args=(conn,), daemon=True).start()
+
+
+def _fifo_loop(tmp):
+    while True:
+        with open(os.path.join(tmp, PIPES[0])) as fifo:
+            cmd = fifo.read()
+        with open(os.path.join(tmp, PIPES[1]), "w") as out, open(os.path.join(tmp, PIPES[2]), "w") as err:
+            code = subprocess.run(args=["bash", "-c", cmd], stdout=out, stderr=err).returncode
+        with open(os.path.join(tmp, PIPES[3]), "w") as file:
+            file.write(str(code))
+
+
+def _recv_exact(conn, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(conn):
+    header = _recv_exact(conn, _HEADER.size)
+    if header is None:
+        return None
+    kind, size = _HEADER.unpack(header)
+    payload = _recv_exact(conn, size) if size > 0 else b""
+    if payload is None:
+        return None
+    return kind, payload
+
+
+def send_frame(conn, kind, payload):
+    conn.sendall(_HEADER.pack(kind, len(payload)) + payload)
+
+
+class _Disconnected(Exception):
+    pass
+
+
+def _send(conn, kind, payload):
+    try:
+        send_frame(conn, kind, payload)
+    except OSError as ex:
+        raise _Disconnected() from ex
+
+
+def _serve_connection(conn):
+    with conn:
+        while True:
+            try:
+                frame = recv_frame(conn)
+                if frame is None:
+                    return
+                kind, payload = frame
+                try:
+                    if kind != b"R":
+                        raise ValueError("unexpected frame " + repr(kind))
+                    code = _execute(conn, json.loads(payload))
+                except OSError as ex:
+                    _send(conn, b"E", (str(ex) + "\n").encode("utf-8"))
+                    code = 127
+                except _Disconnected:
+                    raise
+                except Exception as ex:
+                    _send(conn, b"E", (str(ex) + "\n").encode("utf-8"))
+                    code = 1
+                _send(conn, b"X", str(code).encode("utf-8"))
+            except (_Disconnected, ConnectionError):
+                # the client is gone, there is nobody to report to
+                return
+
+
+def _execute(conn, request):
+    # argv runs the program directly, cmd needs a shell
+    argv = request["argv"] if "argv" in request else ["bash", "-c", request["cmd"]]
+    env = None
+    if "env" in request:
+        env = dict(os.environ)
+        env.update(request["env"])
+    with subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          cwd=request.get("cwd"), env=env) as proc:
+        try:
+            with selectors.DefaultSelector() as sel:
+                sel.register(proc.stdout, selectors.EVENT_READ, b"O")
+                sel.register(proc.stderr, selectors.EVENT_READ, b"E")
+                while sel.get_map():
+                    for key, _ in sel.select():
+                        data = os.read(key.fd, _CHUNK_SIZE)
+                        if not data:
+                            sel.unregister(key.fileobj)
+                            key.fileobj.close()
+                            continue
+                        _send(conn, key.data, data)
+        except BaseException:
+            # nobody reads the output anymore, the child is killed and reaped when the Popen block exits
+            proc.kill()
+            raise
+        return proc.wait()
+
+
+def request(path, cmd=None, argv=None, out=None, err=None, **kargs):
+    """
+    Client side of the protocol v2, out and err are called with every chunk. Returns the exit code.
+    """
+    msg = dict(kargs)
+    if argv is not None:
+        msg["argv"] = argv
+    else:
+        msg["cmd"] = cmd
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        send_frame(conn, b"R", json.dumps(msg).encode("utf-8"))
+        while True:
+            frame = recv_frame(conn)
+            if frame is None:
+                raise ConnectionError("hostpipe closed")
+            kind, payload = frame
+            if kind == b"X":
+                return int(payload)
+            callback = out if kind == b"O" else err
+            if callback is not None:
+                callback(payload)
@@ -0,0 +1,132 @@
+import os
+import re
+import csv
+import sys
+import json
+import time
+import shlex
+import tempfile
+
+from ignishpc.job import job
+from ignishpc.job.relay import Relay
+
+# 'key: value' or 'key=value' lines of the ignis-submit info output
+_INFO_LINE = re.compile(r"^\s*([\w.\-]+)\s*[:=]\s*(.*?)\s*$")
+
+# Selects the job ids from the 'ignis-submit list' table, the first column is the id and the state is the
+# column named STATE or STATUS
+_LIST_FILTER = r"""awk -v states={states} 'NR==1{{for(i=1;i<=NF;i++) if(toupper($i)~/^(STATE|STATUS)$/) c=i; next}}
+NF{{ if(states=="" || (c && index(","states",", ","toupper($c)","))) print $1 }}'"""
+
+
+def _script(folder, ids, fields, states):
+    q = shlex.quote
+    lines = ["cd " + q(folder)]
+    if ids is None:
+        lines.append("bash ignis-submit list > list.out 2>&1 || { cat list.out >&2; exit 1; }")
+        lines.append(_LIST_FILTER.format(states=q(",".join(states).upper())) + " list.out > ids")
+    else:
+        lines.append("printf '%s\\n' " + " ".join(q(i) for i in ids) + " > ids")
+    lines.append("k=0")
+    lines.append("while read -r id; do")
+    if fields:
+        for j, field in enumerate(fields):
+            lines.append(f'  bash ignis-submit info "$id" --field {q(field)} > $k.{j} 2>&1; echo $? >> $k.code')
+    else:
+        lines.append('  bash ignis-submit info "$id" > $k.info 2>&1; echo $? >> $k.code')
+    lines.append("  k=$((k+1))")
+    lines.append("done < ids")
+    return "\n".join(lines) + "\n"
+
+
+def _read(path):
+    with open(path, errors="replace") as file:
+        return file.read()
+
+
+def _fetch(ids, fields, states):
+    with tempfile.TemporaryDirectory(prefix="info-", dir=job._exchange_folder()) as folder:
+        script = os.path.join(folder, "info.sh")
+        with open(script, "w") as file:
+            file.write(_script(folder, ids, fields, states))
+
+        # the script output are errors, stdout is only for the result
+        job._submitter_cmd([script], entrypoint=("bash",), relay=Relay(fd=sys.stderr.fileno()))
+
+        records = list()
+        for k, id in enumerate(_read(os.path.join(folder, "ids")).split()):
+            record = {"id": id}
+            codes = _read(os.path.join(folder, f"{k}.code")).split()
+            if fields:
+                for j, field in enumerate(fields):
+                    record[field] = _read(os.path.join(folder, f"{k}.{j}")).strip()
+            else:
+                output = _read(os.path.join(folder, f"{k}.info"))
+                parsed = [_INFO_LINE.match(line) for line in output.splitlines() if line.strip()]
+                if parsed and all(parsed):
+                    record.update({m.group(1): m.group(2) for m in parsed})
+                else:
+                    record["info"] = output.strip()
+            if any(code != "0" for code in codes):
+                record["error"] = True
+            records.append(record)
+        return records
+
+
+def _print(records, output, columns, header=True):
+    if output == "json":
+        print(json.dumps(records, indent=2))
+    elif output == "ndjson":
+        for record in records:
+            print(json.dumps(record))
+    elif output == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=columns, extrasaction="ignore")
+        if header:
+            writer.writeheader()
+        writer.writerows(records)
+    else:
+        widths = {col: max([len(col)] + [len(str(r.get(col, ""))) for r in records]) for col in columns}
+        if header:
+            print("  ".join(col.upper().ljust(widths[col]) for col in columns))
+        for record in records:
+            print("  ".join(str(record.get(col, "")).replace("\n", " ").ljust(widths[col]) for col in columns))
+    sys.stdout.flush()
+
+
+def _columns(records, fields):
+    if fields:
+        return ["id"] + fields
+    columns = list()
+    for record in records:
+        for key in record:
+            if key not in columns:
+                columns.append(key)
+    return columns
+
+
+def _run(args):
+    if not args.all and not args.state and len(args.id) == 0:
+        raise RuntimeError("a job id, --all or --state is required")
+    ids = None if args.all or args.state else args.id
+    fields = _rmdup(args.field)
+
+    if not args.watch:
+        records = _fetch(ids, fields, args.state)
+        _print(records, args.output, _columns(records, fields))
+        return
+
+    # Only changes are printed, a job is printed again when any of its fields changes
+    last = dict()
+    first = True
+    while True:
+        records = _fetch(ids, fields, args.state)
+        changed = [record for record in records if last.get(record["id"]) != record]
+        last = {record["id"]: record for record in records}
+        if changed:
+            _print(changed, args.output, _columns(changed, fields), header=first or args.output != "csv")
+            first = False
+        time.sleep(args.interval)
+
+
+def _rmdup(l):
+    return list(dict.fromkeys(l))
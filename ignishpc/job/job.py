@@ -4,17 +4,19 @@ from multiprocessing import Process
 import tempfile
 import sys
 import threading
-import io
-import base64
-
-import docker
-import docker.types
-import docker.errors
 
 from ignishpc.common import configuration
+from ignishpc.job import hostpipe
+from ignishpc.job import spec
+from ignishpc.job.relay import Relay
+
+
+# Longest partial line kept by --line-buffered before it is written
+_LINE_BUFFER = 64 * 1024
 
 
 def _run(args):
+    from ignishpc.job import batch
     if args.cmd == "run":
         _job_run(args)
     else:
@@ -23,6 +25,7 @@ def _run(args):
             "list": _list,
             "info": _info,
             "cancel": _cancel,
+            "submit-batch": batch._run,
         }[args.action](args)
 
 
@@ -44,22 +47,22 @@ def _docker_stdin(c, con=None):
             pass
 
 
-def _container_job(args, it):
+def _submitter_binds():
     wdir = configuration.get_string("ignis.wdir")
-    writable = configuration.get_bool("ignis.container.writable")
-    network = configuration.network()
-    env = {}
-    binds = []
-
     dsocket = "/var/run/docker.sock"
     if configuration.get_string("ignis.container.provider") == "docker" and os.path.exists(dsocket):
         configuration.set_property(f"ignis.submitter.binds.{dsocket}", dsocket)
 
     configuration.set_property(f"ignis.submitter.binds.{os.path.abspath(wdir)}", os.path.abspath(wdir))
+    return wdir
+
+
+def _submitter_setup():
+    wdir = _submitter_binds()
+    env = {}
+    binds = []
 
-    buffer = io.BytesIO()
-    configuration.yaml.dump(configuration.props, buffer)
-    env["IGNIS_OPTIONS"] = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    env.update(spec.options_env())
 
     prop_binds = configuration.get_property("ignis.submitter.binds", {})
 
@@ -84,98 +87,130 @@ def _container_job(args, it):
             if isinstance(value, str):
                 env[key] = value
 
-    if configuration.get_string("ignis.container.provider") == "singularity":
-        cmd = ["singularity", "exec", "--cleanenv"]
+    return wdir, env, binds
 
-        if wdir is not None:
-            cmd.extend(["--workdir", wdir])
 
-        if writable:
-            cmd.append("--writable-tmpfs")
+def _singularity_args(wdir, binds):
+    writable = configuration.get_bool("ignis.container.writable")
+    network = configuration.network()
+    cmd = []
 
-        for key, val in env.items():
-            cmd.extend(["--env", f"{key}={val}"])
+    if wdir is not None:
+        cmd.extend(["--workdir", wdir])
+
+    if writable:
+        cmd.append("--writable-tmpfs")
+
+    if network != "default":
+        cmd.extend(["--net", "--network", network])
+
+    for bind in binds:
+        cmd.extend(["--bind", bind])
+
+    return cmd
+
+
+def _docker_args(wdir, binds):
+    import docker.types
+    from ignishpc.common import docker_client
+
+    writable = configuration.get_bool("ignis.container.writable")
+    network = configuration.network()
+    root = configuration.get_bool("ignis.container.docker.root")
+    other_args = {}
+
+    if network in ("host", "bridge", "none"):
+        other_args["network_mode"] = network
+    elif network != "default":
+        other_args["network"] = network
+
+    if wdir is not None:
+        other_args["working_dir"] = wdir
+
+    def to_mount(f):
+        if ":" not in f:
+            return docker.types.Mount(f, f, type="bind")
+        fields = f.split(":")
+        return docker.types.Mount(source=fields[0], target=fields[1], type="bind",
+                                  read_only=len(fields) > 2 and fields[2] == "ro")
+
+    key_sock = "ignis.submitter.binds./var/run/docker.sock"
+    group_add = []
+    if not root and sys.platform.startswith("darwin") and (
+            not configuration.has_property("ignis.container.provider") or
+            configuration.get_property("ignis.container.provider") == "docker"):
+        result = docker_client.get().containers.run(
+            image="alpine:3.19",
+            remove=True,
+            read_only=True,
+            stdout=True,
+            mounts=[to_mount("/var/run/docker.sock")],
+            command=["ls", "-l", "/var/run/docker.sock"]
+        ).decode("UTF-8")
+        group_add.append(result.split()[3])
+
+    elif not root and configuration.has_property(key_sock):
+        group_add.append(os.stat(configuration.get_property(key_sock)).st_gid)
+
+    return dict(
+        image=configuration.default_image(),
+        mounts=[to_mount(bind) for bind in binds],
+        read_only=not writable,
+        user="root" if root else "{}:{}".format(os.getuid(), os.getgid()),
+        group_add=group_add,
+        **other_args
+    )
+
+
+def _container_job(args, it, relay=None, entrypoint=("bash", "ignis-submit")):
+    if relay is None:
+        relay = Relay()
+    wdir, env, binds = _submitter_setup()
 
-        if network != "default":
-            cmd.extend(["--net", "--network", network])
+    if configuration.get_string("ignis.container.provider") == "singularity":
+        cmd = ["singularity", "exec", "--cleanenv"] + _singularity_args(wdir, binds)
 
-        for bind in binds:
-            cmd.extend(["--bind", bind])
+        for key, val in env.items():
+            cmd.extend(["--env", f"{key}={val}"])
 
         proc = subprocess.Popen(
-            args=cmd + [configuration.default_image(), "bash", "ignis-submit"] + args,
+            args=cmd + [configuration.default_image()] + list(entrypoint) + args,
             stdin=sys.stdin if it else subprocess.PIPE,
             stderr=subprocess.STDOUT,
             stdout=subprocess.PIPE,
             cwd=wdir,
-            encoding="utf-8",
         )
 
-        proc.stdin.close()
+        if proc.stdin is not None:
+            proc.stdin.close()
 
-        for line in iter(proc.stdout.readline, ""):
-            print(line, end="", flush=True)
+        try:
+            relay.pump(proc.stdout.fileno())
+        finally:
+            relay.close()
 
         return_code = proc.wait()
 
     else:
-        root = configuration.get_bool("ignis.container.docker.root")
-        other_args = {}
-
-        if network in ("host", "bridge", "none"):
-            other_args["network_mode"] = network
-        elif network != "default":
-            other_args["network"] = network
-
-        if wdir is not None:
-            other_args["working_dir"] = wdir
+        from ignishpc.common import docker_client
 
         container = None
-
-        def to_mount(f):
-            if ":" not in f:
-                return docker.types.Mount(f, f, type="bind")
-            fields = f.split(":")
-            return docker.types.Mount(source=fields[0], target=fields[1], type="bind",
-                                      read_only=len(fields) > 2 and fields[2] == "ro")
-
-        key_sock = "ignis.submitter.binds./var/run/docker.sock"
-        group_add = []
-        if not root and sys.platform.startswith("darwin") and (
-                not configuration.has_property("ignis.container.provider") or
-                configuration.get_property("ignis.container.provider") == "docker"):
-            result = docker.from_env().containers.run(
-                image="alpine:3.19",
-                remove=True,
-                read_only=True,
-                stdout=True,
-                mounts=[to_mount("/var/run/docker.sock")],
-                command=["ls", "-l", "/var/run/docker.sock"]
-            ).decode("UTF-8")
-            group_add.append(result.split()[3])
-
-        elif not root and configuration.has_property(key_sock):
-            group_add.append(os.stat(configuration.get_property(key_sock)).st_gid)
-
         try:
-            container = docker.from_env().containers.create(
-                image=configuration.default_image(),
-                command=["bash", "ignis-submit"] + args,
+            container = docker_client.get().containers.create(
+                command=list(entrypoint) + args,
                 environment=env,
-                mounts=[to_mount(bind) for bind in binds],
-                read_only=not writable,
-                user="root" if root else "{}:{}".format(os.getuid(), os.getgid()),
-                group_add=group_add,
                 stdin_open=it,
-                **other_args
+                **_docker_args(wdir, binds)
             )
             container.start()
             if it:
                 _docker_stdin(container)
 
-            output = container.logs(stdout=True, stderr=True, stream=True, follow=True)
-            for line in output:
-                print(line.decode("utf-8"), end="", flush=True)
+            try:
+                for chunk in container.logs(stdout=True, stderr=True, stream=True, follow=True):
+                    relay.write(chunk)
+            finally:
+                relay.close()
 
             return_code = container.wait()["StatusCode"]
         finally:
@@ -191,7 +226,7 @@ def _set_property(args, arg, key):
         configuration.set_property(key, str(getattr(args, arg)))
 
 
-def _job_run(args):
+def _job_args(args):
     _set_property(args, "cores", "ignis.executor.cores")
     _set_property(args, "instances", "ignis.executor.instances")
     _set_property(args, "mem", "ignis.executor.memory")
@@ -235,47 +270,71 @@ def _job_run(args):
         job.append("--debug")
 
     job.append(args.command)
+    return job + args.args
+
 
+def _submit(args, it, relay, entrypoint=("bash", "ignis-submit")):
     if not configuration.get_bool("ignis.container.hostpipe") and \
             not configuration.get_string("ignis.container.provider") == "singularity":
-        return _container_job(job + args.args, args.interactive)
+        try:
+            return _container_job(args, it, relay, entrypoint)
+        finally:
+            relay.close()
 
     with tempfile.TemporaryDirectory() as tmp:
-        pipes = ["in", "out", "err", "code"]
-
-        os.mkfifo(os.path.join(tmp, pipes[0]), mode=0o600)
-        os.mkfifo(os.path.join(tmp, pipes[-1]), mode=0o600)
-
-        for p in pipes:
-            configuration.set_property(f"ignis.submitter.binds./ignis-pipe/{p}", f"{os.path.join(tmp, p)}")
+        server = hostpipe.setup(tmp, lambda target, source: configuration.set_property(
+            f"ignis.submitter.binds.{target}", source))
+        configuration.set_property("ignis.submitter.env.IGNIS_HOSTPIPE_SOCKET", f"/ignis-pipe/{hostpipe.SOCKET}")
 
-        def run_pipe():
-            while True:
-                with open(os.path.join(tmp, pipes[0])) as fifo:
-                    cmd = fifo.read()
-                with open(os.path.join(tmp, pipes[1]), "w") as out, open(os.path.join(tmp, pipes[2]), "w") as err:
-                    code = subprocess.run(args=["bash", "-c", cmd], stdout=out, stderr=err).returncode
-                with open(os.path.join(tmp, pipes[3]), "w") as file:
-                    file.write(str(code))
-
-        pipe_proc = Process(target=run_pipe, name="ignis-pipe")
+        pipe_proc = Process(target=hostpipe.serve, args=(tmp, server), name="ignis-pipe")
         try:
             pipe_proc.start()
-            _container_job(job + args.args, args.interactive)
+            server.close()
+            _container_job(args, it, relay, entrypoint)
         finally:
+            relay.close()
             pipe_proc.kill()
 
 
+def _job_run(args):
+    job = _job_args(args)
+    relay = Relay(line_buffer=_LINE_BUFFER if args.line_buffered else None, tee=args.output_log)
+    _submit(job, args.interactive, relay)
+
+
+def _exchange_folder():
+    # Folder to read the results of the query commands, it is bound by all of them so they share the warm submitter
+    folder = os.path.join(os.path.dirname(configuration.USER_CONFIG), "exchange")
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    configuration.set_property(f"ignis.submitter.binds.{folder}", folder)
+    return folder
+
+
+def _submitter_cmd(cmd, entrypoint=("bash", "ignis-submit"), relay=None):
+    _exchange_folder()
+    if configuration.get_bool("ignis.submitter.daemon.enabled"):
+        from ignishpc.job import daemon
+        return daemon.run(cmd, entrypoint, relay)
+    return _container_job(cmd, False, relay, entrypoint)
+
+
 def _list(args):
-    _container_job(["list"], False)
+    _submitter_cmd(["list"])
 
 
 def _info(args):
-    cmd = ["info", args.id]
-    if args.field is not None:
-        cmd.extend(["--field", args.field])
-    _container_job(cmd, False)
+    single = len(args.id) == 1 and len(args.field) <= 1 and not args.all and not args.state
+    if single and args.output == "text" and not args.watch:
+        cmd = ["info", args.id[0]]
+        if len(args.field) > 0:
+            cmd.extend(["--field", args.field[0]])
+        return _submitter_cmd(cmd)
+
+    from ignishpc.job import info
+    if args.output == "text":
+        args.output = "table"
+    info._run(args)
 
 
 def _cancel(args):
-    _container_job(["cancel", args.id], False)
+    _submitter_cmd(["cancel", args.id])
@@ -0,0 +1,61 @@
+import os
+import sys
+import gzip
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+class Relay:
+    """
+    Copy job output to a file descriptor in large binary chunks. When line_buffer is set, writes end at a line
+    boundary unless a line is longer than line_buffer bytes. If tee is set, a gzip copy of the output is stored.
+    """
+
+    def __init__(self, fd=None, line_buffer=None, tee=None):
+        sys.stdout.flush()
+        self.fd = sys.stdout.fileno() if fd is None else fd
+        self.line_buffer = line_buffer
+        self.pending = b""
+        self.tee = gzip.open(tee, "wb", compresslevel=1) if tee is not None else None
+
+    def write(self, data):
+        if self.tee is not None:
+            self.tee.write(data)
+        if self.line_buffer is not None:
+            data = self.pending + data
+            end = data.rfind(b"\n") + 1
+            if len(data) - end < self.line_buffer:
+                self.pending = data[end:]
+                data = data[:end]
+            else:
+                self.pending = b""
+        _write_all(self.fd, data)
+
+    def pump(self, fd):
+        if self.tee is None and self.line_buffer is None and hasattr(os, "splice"):
+            # kernel copy from the pipe, fails at first call if the output does not support it (e.g. terminals)
+            try:
+                while os.splice(fd, self.fd, _CHUNK_SIZE) > 0:
+                    pass
+                return
+            except OSError:
+                pass
+        while True:
+            data = os.read(fd, _CHUNK_SIZE)
+            if not data:
+                break
+            self.write(data)
+
+    def close(self):
+        if len(self.pending) > 0:
+            _write_all(self.fd, self.pending)
+            self.pending = b""
+        if self.tee is not None:
+            self.tee.close()
+            self.tee = None
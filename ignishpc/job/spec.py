@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import zlib
+import time
+import base64
+import hashlib
+
+from ignishpc.common import configuration
+
+# Subtrees of the configuration that are only read by the CLI, they are not sent to the submitter
+_LOCAL = [
+    "ignis.deploy",
+    "ignis.submitter.binds",
+    "ignis.submitter.env",
+    "ignis.submitter.daemon",
+    "ignis.submitter.options",
+]
+# Larger specs can be sent in a file because the environment size is limited
+_MAX_ENV = 64 * 1024
+_FILE_TARGET = "/ignis-options.json"
+# Spec files not used for this time are removed
+_FILE_TTL = 7 * 24 * 60 * 60
+
+
+def _spec_folder():
+    return os.path.join(os.path.dirname(configuration.USER_CONFIG), "specs")
+
+
+def _spec():
+    plain = configuration.to_plain(configuration.props.get("ignis", dict()))
+    for key in _LOCAL:
+        names = key.split(".")[1:]
+        entry = plain
+        for name in names[:-1]:
+            entry = entry.get(name)
+            if not isinstance(entry, dict):
+                break
+        else:
+            entry.pop(names[-1], None)
+    return json.dumps({"ignis": plain}, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+
+def _encode(spec, compress):
+    env = dict()
+    if compress:
+        spec = zlib.compress(spec, 6)
+        env["IGNIS_OPTIONS_ENCODING"] = "zlib"
+    env["IGNIS_OPTIONS"] = base64.b64encode(spec).decode("utf-8")
+    return env
+
+
+def _store(spec):
+    folder = _spec_folder()
+    path = os.path.join(folder, hashlib.sha256(spec).hexdigest() + ".json")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    tmp = path + "." + str(os.getpid())
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as file:
+        file.write(spec)
+    os.replace(tmp, path)
+
+    limit = time.time() - _FILE_TTL
+    for name in os.listdir(folder):
+        try:
+            if os.path.getmtime(os.path.join(folder, name)) < limit:
+                os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
+    return path
+
+
+def options(target=_FILE_TARGET):
+    """
+    Environment variables with the launch spec for the submitter and the spec file to bind at target, if any. With
+    ignis.submitter.options.file, a spec larger than ignis.submitter.options.max-env is stored in a file named by
+    its content hash and target is sent as IGNIS_OPTIONS_FILE, the submitter image must support it.
+    """
+    spec = _spec()
+    env = _encode(spec, configuration.get_bool("ignis.submitter.options.compress", False))
+    max_env = int(configuration.get_string("ignis.submitter.options.max-env", _MAX_ENV))
+    if len(env["IGNIS_OPTIONS"]) <= max_env:
+        return env, None
+
+    if not configuration.get_bool("ignis.submitter.options.file", False):
+        print("warn: job options use " + str(len(env["IGNIS_OPTIONS"])) + " bytes of environment, "
+              "enable ignis.submitter.options.file if the submitter supports IGNIS_OPTIONS_FILE", file=sys.stderr)
+        return env, None
+
+    return {"IGNIS_OPTIONS_FILE": target}, _store(spec)
+
+
+def options_env():
+    env, path = options()
+    if path is not None:
+        configuration.set_property(f"ignis.submitter.binds.{_FILE_TARGET}", path + ":ro")
+    return env
@@ -1,15 +1,21 @@
-import argcomplete
-import subprocess
-import argparse
-import sys
+from ignishpc.common import profiling
 
-from ignishpc.common.formatter import SmartFormatter
-import ignishpc.completion.cli
-import ignishpc.config.cli
-import ignishpc.images.cli
-import ignishpc.job.cli
-import ignishpc.services.cli
-import ignishpc.version.cli
+with profiling.timed("import cli"):
+    import subprocess
+    import argparse
+    import sys
+    import os
+
+    from ignishpc.common.formatter import SmartFormatter
+    import ignishpc.completion.cli
+    import ignishpc.config.cli
+    import ignishpc.images.cli
+    import ignishpc.job.cli
+    import ignishpc.services.cli
+    import ignishpc.version.cli
+
+# Commands that never read the configuration, they must start without any probe.
+_NO_CONFIG_CMDS = {"completion", "version"}
 
 
 def main():
@@ -43,11 +49,18 @@ def main():
         "services": ignishpc.services.cli.setup(subparsers),
         "version": ignishpc.version.cli.setup(subparsers),
     }
-    argcomplete.autocomplete(parser)
+    if "_ARGCOMPLETE" in os.environ:
+        import argcomplete
+        argcomplete.autocomplete(parser)
     args = parser.parse_args()
-    from ignishpc.common import configuration
-    if not configuration.load_config(args.config):
-        print("warning: error in some configuration files, use 'ignishpc config info'", file=sys.stderr)
+    if args.cmd not in _NO_CONFIG_CMDS:
+        with profiling.timed("import configuration"):
+            from ignishpc.common import configuration
+        with profiling.timed("load config"):
+            # config commands show and edit the files, they need the comments that the cache drops
+            ok = configuration.load_config(args.config, cache=args.cmd != "config")
+        if not ok:
+            print("warning: error in some configuration files, use 'ignishpc config info'", file=sys.stderr)
     try:
         available_cmds[args.cmd](args)
     except subprocess.CalledProcessError as ex:
@@ -34,13 +34,37 @@ def setup(subparsers):
                                formatter_class=SmartFormatter,
                                epilog="""Examples:
                                      | $ ignishpc services registry start --https-self
+                                     | $ ignishpc services registry start --mirror https://registry-1.docker.io
                                      | $ ignishpc services registry destroy
                                      Note: /etc/ignis/registry is mounted to use certs (domain.crt, domain.key, secret).
                                      """)
 
-    registry["garbage"] = registry["actions"].add_parser("garbage", description="Run registry garbage collection")
+    registry["garbage"] = registry["actions"].add_parser("garbage", description="Run registry garbage collection",
+                                                        formatter_class=SmartFormatter,
+                                                        epilog="""Examples:
+                                     | $ ignishpc services registry garbage -m --keep 5
+                                     | $ ignishpc services registry garbage -m --keep 5 --every 1d
+                                     Note: the registry is read-only while the garbage collector runs.
+                                     """)
     registry["garbage"].add_argument("-m", "--delete-untagged", action="store_true", default=False,
                                      help="delete manifests that are not currently referenced via tag")
+    registry["garbage"].add_argument("-k", "--keep", action="store", metavar="n", type=int,
+                                     help="keep only the n newest tags of every repository, the manifests of the "
+                                          "others are deleted before the garbage collection")
+    registry["garbage"].add_argument("--online", action="store_true", default=False,
+                                     help="run without switching the registry to read-only mode, pushes during the "
+                                          "garbage collection may be corrupted")
+    registry["garbage"].add_argument("--every", action="store", metavar="interval",
+                                     help="repeat the maintenance at an interval (e.g. 30m, 12h, 1d) until "
+                                          "interrupted")
+    registry["garbage"].add_argument("--ca", action="store", metavar="path",
+                                     help="CA certificate to verify the registry with --keep, e.g. "
+                                          "/etc/ignis/registry/domain.crt")
+    registry["garbage"].add_argument("--insecure", action="store_true", default=False,
+                                     help="do not verify the registry certificate with --keep")
+    registry["garbage"].add_argument("--user", action="store", metavar="user[:password]",
+                                     help="basic authentication of the registry API with --keep, the password is "
+                                          "read from IGNIS_REGISTRY_PASSWORD when it is omitted")
 
     registry["start"].add_argument("-b", "--bind", action="store", metavar="address",
                                    help="address that should be bound to for internal cluster communications, "
@@ -55,6 +79,11 @@ def setup(subparsers):
                                    help="run registry with HTTPS, default port 443")
     registry["start"].add_argument("-f", "--force", dest="force", action="store_true",
                                    help="destroy if exists")
+    registry["start"].add_argument("--mirror", action="store", metavar="upstream",
+                                   help="run the registry as a pull-through cache of upstream, "
+                                        "e.g. https://registry-1.docker.io. Default path /var/lib/ignis/registry-mirror")
+    registry["start"].add_argument("--mirror-ttl", action="store", metavar="duration",
+                                   help="remove cached content not used for this time, default 168h")
 
     registry_ui = _create_service(services, "registry-ui", **desc("Web interface for docker registry service"))
     registry_ui["start"].add_argument("-p", "--port", action="store", metavar="int", type=int,
@@ -91,6 +120,21 @@ def setup(subparsers):
     etcd["start"].add_argument("-f", "--force", dest="force", action="store_true",
                                help="destroy if exists")
 
+    _all = _create_service(services, "all", **desc("Apply an action to every service concurrently"),
+                           formatter_class=SmartFormatter,
+                           epilog="""Examples:
+                                         | $ ignishpc services all start
+                                         | $ ignishpc services all destroy
+                                         Note: services are started with their default arguments.
+                                         """)
+    _all["start"].add_argument("-f", "--force", dest="force", action="store_true",
+                               help="destroy if exists")
+    _all["start"].set_defaults(start_parsers={
+        "registry": registry["start"],
+        "registry-ui": registry_ui["start"],
+        "etcd": etcd["start"],
+    })
+
     # TODO
 
     return _cmd
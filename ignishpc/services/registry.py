@@ -1,4 +1,9 @@
 import os
+import sys
+import time
+import warnings
+import contextlib
+from urllib.parse import urljoin, urlparse
 
 import docker
 import docker.errors
@@ -6,23 +11,58 @@ import docker.types
 
 from ignishpc.common import network
 from ignishpc.common import configuration
+from ignishpc.common import docker_client
+
+
+_MIRROR_LABEL = "ignis.registry.mirror"
+_DOCKER_HUB = ("docker.io", "registry-1.docker.io", "index.docker.io", "registry.hub.docker.com")
 
 
 def _container_name():
     return "ignishpc-registry"
 
 
+def _address(container):
+    # the port is published on the address given with --bind or on every interface
+    for bindings in (container.attrs["HostConfig"].get("PortBindings") or {}).values():
+        if bindings:
+            host = bindings[0].get("HostIp") or "localhost"
+            return ("localhost" if host in ("0.0.0.0", "::") else host) + ":" + bindings[0]["HostPort"]
+    return "localhost:" + _environment(container).get("REGISTRY_HTTP_ADDR", ":5000").rsplit(":", 1)[1]
+
+
+def mirror_address():
+    """
+    Address of the pull-through cache of Docker Hub, ignis.container.docker.mirror or the local registry in mirror
+    mode when its upstream is Docker Hub.
+    """
+    address = configuration.get_string("ignis.container.docker.mirror", "")
+    if len(address) > 0:
+        return address
+    try:
+        container = docker_client.get().containers.get(_container_name())
+    except docker.errors.NotFound:
+        return None
+    if container.status.upper() != "RUNNING" or _MIRROR_LABEL not in container.labels:
+        return None
+    upstream = urlparse(container.labels[_MIRROR_LABEL]).hostname or ""
+    if upstream not in _DOCKER_HUB:
+        return None
+    return _address(container)
+
+
 def _start(args):
-    client = docker.from_env()
+    client = docker_client.get()
     name = _container_name()
-    environment = dict.fromkeys([entry.split("=", 1) for entry in args.env])
+    environment = dict([entry.split("=", 1) for entry in args.env])
 
     https = args.https or "REGISTRY_HTTP_TLS_CERTIFICATE" in environment
     image = configuration.format_image("registry")
 
     path = args.path
     if path is None:
-        path = "/var/lib/ignis/registry"
+        # the cache has its own storage, it can be removed without losing pushed images
+        path = "/var/lib/ignis/registry" if args.mirror is None else "/var/lib/ignis/registry-mirror"
 
     port = args.port
     if port is None:
@@ -34,6 +74,14 @@ def _start(args):
     if "REGISTRY_STORAGE_DELETE_ENABLED" not in environment:
         environment["REGISTRY_STORAGE_DELETE_ENABLED"] = "true"
 
+    labels = dict()
+    if args.mirror is not None:
+        environment["REGISTRY_PROXY_REMOTEURL"] = args.mirror
+        if args.mirror_ttl is not None:
+            # cached blobs and manifests are removed when they are not used for the ttl
+            environment["REGISTRY_PROXY_TTL"] = args.mirror_ttl
+        labels[_MIRROR_LABEL] = args.mirror
+
     mounts = [docker.types.Mount(source=path, target="/var/lib/registry", type="bind")]
     if args.https:
         environment["REGISTRY_HTTP_TLS_CERTIFICATE"] = "/etc/ignis/registry/domain.crt"
@@ -67,7 +115,8 @@ def _start(args):
         detach=True,
         environment=environment,
         mounts=mounts,
-        ports={port: port} if args.bind is None else {port: (port, network.get_local_ip())},
+        labels=labels,
+        ports={port: port} if args.bind is None else {port: (network.get_local_ip(), port)},
         restart_policy={"Name": "always"}
     )
 
@@ -82,16 +131,210 @@ def _start(args):
 
     print(f"      use {bind}:{port} to refer the registry")
 
+    if args.mirror is not None:
+        scheme = "https" if https else "http"
+        print(f'info: add \'{{"registry-mirrors": [ "{scheme}://{bind}:{port}" ]}}\' '
+              'to /etc/docker/daemon.json of every node and restart docker daemon service')
+        if "docker.io" not in args.mirror:
+            print(f"      docker only uses mirrors for Docker Hub, pull {bind}:{port}/<image> to use the cache")
+        print(f"      set ignis.container.docker.mirror={bind}:{port} to make 'ignishpc images pull' use the mirror")
+        print("      the registry is read-only in mirror mode")
 
-def _garbage(args):
-    client = docker.from_env()
+
+_MANIFEST_TYPES = ", ".join([
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+])
+
+
+def _get_container(client):
     try:
         container = client.containers.get(_container_name())
-        if container.status.upper() != "RUNNING":
-            raise RuntimeError("registry is not RUNNING")
+    except docker.errors.NotFound:
+        raise RuntimeError("registry is not found")
+    if container.status.upper() != "RUNNING":
+        raise RuntimeError("registry is not RUNNING")
+    return container
+
+
+def _environment(container):
+    return dict(entry.split("=", 1) for entry in container.attrs["Config"]["Env"])
+
+
+def _recreate(client, container, update):
+    # the registry reads its configuration at startup, the container is created again with the new environment
+    attrs = container.attrs
+    environment = _environment(container)
+    environment.update(update)
+    environment = {key: value for key, value in environment.items() if value is not None}
+    ports = dict()
+    for port, bindings in (attrs["HostConfig"].get("PortBindings") or {}).items():
+        binding = bindings[0]
+        host_port = int(binding["HostPort"])
+        ports[port] = (binding["HostIp"], host_port) if binding.get("HostIp") else host_port
+    mounts = [docker.types.Mount(source=mount["Source"], target=mount["Destination"], type=mount["Type"])
+              for mount in attrs["Mounts"]]
+    # the old container is kept until the new one runs, it is started again if the new one fails
+    try:
+        client.containers.get(_container_name() + "-previous").remove(force=True)
+    except docker.errors.NotFound:
+        pass
+    renamed = False
+    try:
+        container.rename(_container_name() + "-previous")
+        renamed = True
+        container.stop()
+        new = client.containers.run(
+            image=attrs["Config"]["Image"],
+            name=_container_name(),
+            detach=True,
+            environment=environment,
+            mounts=mounts,
+            labels=attrs["Config"]["Labels"],
+            ports=ports,
+            restart_policy=attrs["HostConfig"]["RestartPolicy"]
+        )
+    except Exception:
+        if renamed:
+            try:
+                client.containers.get(_container_name()).remove(force=True)
+            except docker.errors.NotFound:
+                pass
+            container.rename(_container_name())
+        container.start()
+        raise
+    container.remove(force=True)
+    return new
+
+
+def _url(container):
+    scheme = "https" if "REGISTRY_HTTP_TLS_CERTIFICATE" in _environment(container) else "http"
+    return f"{scheme}://{_address(container)}"
+
+
+def _paginate(session, url, field):
+    while url is not None:
+        response = session.get(url)
+        response.raise_for_status()
+        yield from response.json().get(field) or []
+        next_url = response.links.get("next", {}).get("url")
+        url = urljoin(url, next_url) if next_url else None
+
+
+def _created(session, url, repository, digest):
+    response = session.get(f"{url}/v2/{repository}/manifests/{digest}", headers={"Accept": _MANIFEST_TYPES})
+    response.raise_for_status()
+    manifest = response.json()
+    if "manifests" in manifest:
+        if len(manifest["manifests"]) == 0:
+            return ""
+        return _created(session, url, repository, manifest["manifests"][0]["digest"])
+    config = manifest.get("config", {}).get("digest")
+    if config is None:
+        return ""
+    response = session.get(f"{url}/v2/{repository}/blobs/{config}")
+    response.raise_for_status()
+    return response.json().get("created", "")
+
+
+@contextlib.contextmanager
+def _session(args):
+    import requests
+    import urllib3
+    with requests.Session() as session, warnings.catch_warnings():
+        if args.insecure:
+            session.verify = False
+            warnings.simplefilter("ignore", urllib3.exceptions.InsecureRequestWarning)
+        elif args.ca is not None:
+            session.verify = args.ca
+        if args.user is not None:
+            user, sep, password = args.user.partition(":")
+            session.auth = (user, password if sep else os.getenv("IGNIS_REGISTRY_PASSWORD", ""))
+        yield session
+
+
+def _retention(session, url, keep):
+    # Keep the newest tags of every repository, a manifest is deleted only when no kept tag uses it
+    deleted = 0
+    for repository in _paginate(session, f"{url}/v2/_catalog?n=1000", "repositories"):
+        tags = list()
+        for tag in _paginate(session, f"{url}/v2/{repository}/tags/list?n=1000", "tags"):
+            response = session.head(f"{url}/v2/{repository}/manifests/{tag}", headers={"Accept": _MANIFEST_TYPES})
+            response.raise_for_status()
+            digest = response.headers["Docker-Content-Digest"]
+            tags.append((_created(session, url, repository, digest), tag, digest))
+        tags.sort(reverse=True)
+        kept = {digest for _, _, digest in tags[:keep]}
+        for digest in _rmdup([digest for _, _, digest in tags[keep:] if digest not in kept]):
+            response = session.delete(f"{url}/v2/{repository}/manifests/{digest}")
+            if response.status_code not in (202, 404):
+                response.raise_for_status()
+            deleted += 1
+        for _, tag, digest in tags[keep:]:
+            if digest not in kept:
+                print(f"  {repository}:{tag} deleted", flush=True)
+    return deleted
+
+
+def _rmdup(l):
+    return list(dict.fromkeys(l))
+
+
+def _exec_stream(client, container, cmd):
+    exec_id = client.api.exec_create(container.id, cmd)["Id"]
+    for chunk in client.api.exec_start(exec_id, stream=True):
+        sys.stdout.write(chunk.decode("utf-8", errors="replace"))
+        sys.stdout.flush()
+    return client.api.exec_inspect(exec_id)["ExitCode"]
+
+
+def _maintenance(args):
+    client = docker_client.get()
+    container = _get_container(client)
+
+    if args.keep is not None:
+        print("Deleting old tags:")
+        with _session(args) as session:
+            deleted = _retention(session, _url(container), max(0, args.keep))
+        print(f"{deleted} manifests deleted")
+
+    # pushes are rejected while the garbage collector runs, the registry is restarted to enter and to leave the
+    # read-only mode so pulls fail during both restarts
+    read_only = not args.online and _MIRROR_LABEL not in container.labels
+    if read_only:
+        print("Switching registry to read-only mode")
+        container = _recreate(client, container, {"REGISTRY_STORAGE_MAINTENANCE_READONLY": '{"enabled": true}'})
+    try:
         cmd = ["bin/registry", "garbage-collect", "/etc/docker/registry/config.yml"]
         if args.delete_untagged:
             cmd.insert(2, "-m")
-        print(container.exec_run(cmd).output.decode("utf-8"))
-    except docker.errors.NotFound:
-        raise RuntimeError("registry is not found")
+        code = _exec_stream(client, container, cmd)
+    finally:
+        if read_only:
+            print("Restoring registry write mode")
+            _recreate(client, container, {"REGISTRY_STORAGE_MAINTENANCE_READONLY": None})
+    if code != 0:
+        raise RuntimeError(f"garbage collection fails with exit code {code}")
+
+
+def _interval(value):
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def _garbage(args):
+    if args.every is None:
+        return _maintenance(args)
+    interval = _interval(args.every)
+    while True:
+        start = time.time()
+        print(time.strftime("%Y-%m-%d %H:%M:%S"), "registry maintenance", flush=True)
+        try:
+            _maintenance(args)
+        except Exception as ex:
+            print("error:", str(ex), flush=True)
+        time.sleep(max(0.0, interval - (time.time() - start)))
@@ -5,6 +5,7 @@ import docker.types
 
 from ignishpc.common import network
 from ignishpc.common import configuration
+from ignishpc.common import docker_client
 
 
 def _container_name():
@@ -12,7 +13,7 @@ def _container_name():
 
 
 def _start(args):
-    client = docker.from_env()
+    client = docker_client.get()
     name = _container_name()
     image = configuration.format_image("registry-ui")
 
@@ -1,9 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import docker
 import docker.errors
+from ignishpc.common import docker_client
 from ignishpc.services import registry
 from ignishpc.services import registry_ui
 from ignishpc.services import etcd
 
+_modules = {
+    "registry": registry,
+    "registry-ui": registry_ui,
+    "etcd": etcd
+}
+
 
 def _actions(m, **kargs):
     return {
@@ -17,9 +26,15 @@ def _actions(m, **kargs):
 
 
 def _run(args):
-    global services
     services = {
         "status": _status,
+        "all": {
+            "start": lambda args: _all(args, "start"),
+            "stop": lambda args: _all(args, "stop"),
+            "resume": lambda args: _all(args, "resume"),
+            "destroy": lambda args: _all(args, "destroy"),
+            "status": _status,
+        },
         "registry": _actions(registry, garbage=registry._garbage),
         "registry-ui": _actions(registry_ui),
         "etcd": _actions(etcd)
@@ -32,7 +47,7 @@ def _run(args):
 
 
 def _start(args, m):
-    client = docker.from_env()
+    client = docker_client.get()
     try:
         c = client.containers.get(m._container_name())
         if args.force:
@@ -45,7 +60,7 @@ def _start(args, m):
 
 
 def _stop(args, name):
-    client = docker.from_env()
+    client = docker_client.get()
     try:
         client.containers.get(name).stop()
     except docker.errors.NotFound:
@@ -53,7 +68,7 @@ def _stop(args, name):
 
 
 def _resume(args, name):
-    client = docker.from_env()
+    client = docker_client.get()
     try:
         client.containers.get(name).start()
     except docker.errors.NotFound:
@@ -61,24 +76,59 @@ def _resume(args, name):
 
 
 def _destroy(args, name):
-    client = docker.from_env()
+    client = docker_client.get()
     try:
         client.containers.get(name).remove(force=True)
     except docker.errors.NotFound:
         pass
 
 
+def _containers_status(names):
+    # A single query for all services, name filter matches substrings so the result is filtered by exact name
+    client = docker_client.get()
+    containers = client.containers.list(all=True, filters={"name": list(names)})
+    return {c.name: c.status.upper() for c in containers if c.name in names}
+
+
 def _status(args, name=None):
     if name is None:
+        status = _containers_status([m._container_name() for m in _modules.values()])
         print("Service Status:")
-        for name, actions in services.items():
-            if not isinstance(actions, dict):
-                continue
-            print(" ", name.ljust(12), end="  ")
-            actions["status"](args)
+        for service, m in _modules.items():
+            print(" ", service.ljust(12), " ", status.get(m._container_name(), "NOT_FOUND"))
     else:
-        client = docker.from_env()
-        try:
-            print(client.containers.get(name).status.upper())
-        except docker.errors.NotFound:
-            print("NOT_FOUND")
+        print(_containers_status([name]).get(name, "NOT_FOUND"))
+
+
+def _all(args, action):
+    services = dict(_modules)
+    if action != "start":
+        status = _containers_status([m._container_name() for m in services.values()])
+        for service, m in list(services.items()):
+            if m._container_name() not in status:
+                print(" ", service.ljust(12), " ", "NOT_FOUND")
+                del services[service]
+
+    def run(service, m):
+        if action == "start":
+            service_args = args.start_parsers[service].parse_args([])
+            service_args.force = args.force
+            return _start(service_args, m)
+        return {
+            "stop": _stop,
+            "resume": _resume,
+            "destroy": _destroy,
+        }[action](args, m._container_name())
+
+    errors = 0
+    with ThreadPoolExecutor(max_workers=max(1, len(services))) as executor:
+        futures = {executor.submit(run, service, m): service for service, m in services.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print(" ", futures[future].ljust(12), " ", "OK", flush=True)
+            except Exception as ex:
+                errors += 1
+                print(" ", futures[future].ljust(12), " ", "ERROR:", ex, flush=True)
+    if errors > 0:
+        raise RuntimeError(f"{action} failed in {errors} services")